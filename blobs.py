@@ -0,0 +1,85 @@
+import hashlib
+import io
+from glob import escape as glob_escape
+from glob import glob
+from os import makedirs, replace, unlink
+from os.path import dirname, isfile, join, relpath, splitext
+from threading import Lock
+from typing import BinaryIO, Dict
+
+from settings import BLOB_DIR, UPLOAD_PATH
+from utils import packet_stores, seek_indexes
+
+
+class HashingWriter(io.BufferedIOBase):
+    """File wrapper hashing the data while it's being written."""
+
+    def __init__(self, f: BinaryIO):
+        super().__init__()
+        self.f = f
+        self.hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        return self.f.write(data)
+
+    def seek(self, *args) -> int:
+        return self.f.seek(*args)
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+class BlobStore:
+    """Uploaded files stored by their content hash, shared by commands.
+
+    Blobs are placed in a fanned-out directory tree in UPLOAD_PATH, and
+    removed with their renditions when no command references them.
+    """
+
+    # {digest: command count}
+    refs: Dict[str, int]
+
+    def __init__(self, files: Dict[str, dict]):
+        self.refs = {}
+        # blobs are stored and released in worker threads
+        self.lock = Lock()
+        for cmd in files.values():
+            if "hash" in cmd:
+                self.refs[cmd["hash"]] = self.refs.get(cmd["hash"], 0) + 1
+
+    @staticmethod
+    def path(digest: str, ext: str) -> str:
+        return join(UPLOAD_PATH, BLOB_DIR, digest[0:2], digest[2:4], digest + ext)
+
+    def store(self, filename: str, digest: str, original: str) -> str:
+        # returns the path relative to UPLOAD_PATH
+        ext = splitext(original)[1].lower()[0:10]
+        path = self.path(digest, ext)
+        with self.lock:
+            if isfile(path):
+                # the same content was uploaded before
+                unlink(filename)
+            else:
+                makedirs(dirname(path), exist_ok=True)
+                replace(filename, path)
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+        return relpath(path, UPLOAD_PATH)
+
+    def release(self, cmd: dict):
+        digest = cmd["hash"]
+        with self.lock:
+            self.refs[digest] = self.refs.get(digest, 1) - 1
+            if self.refs[digest] > 0:
+                return
+            del self.refs[digest]
+            path = join(UPLOAD_PATH, cmd["filename"])
+            # the renditions, packet stores and seek index next to the blob
+            sidecars = glob(f"{glob_escape(path)}.*")
+            # playing sources keep their own reference to the store
+            for filename in [path] + sidecars:
+                packet_stores.pop(filename, None)
+            seek_indexes.pop(path, None)
+            for filename in [path] + sidecars:
+                if isfile(filename):
+                    unlink(filename)
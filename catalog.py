@@ -0,0 +1,156 @@
+import asyncio
+import atexit
+import json
+from os import replace, scandir, stat
+from os.path import isfile, join
+from threading import Lock
+from typing import Dict, List, Optional, Set
+
+from probe import probe, probe_all, probe_pool
+from settings import CATALOG_SAVE_TIME, PACKS_JSON
+from utils import offload
+
+
+class PackCatalog:
+    """Index of music pack tracks, rescanned only when a pack directory changes.
+
+    Changes are detected by polling the directory modification time when
+    the tracks are requested, or explicitly by calling update(). PACKS_JSON
+    is written every CATALOG_SAVE_TIME seconds, if anything changed.
+    """
+
+    # {dirname: {"mtime": float, "tracks": {name: {"size", "mtime", "info"}}}}
+    packs: Dict[str, dict]
+    # {dirname: [...filename]}
+    paths: Dict[str, List[str]]
+    # {filename}, probed in the background
+    probing: Set[str]
+
+    def __init__(self):
+        self.packs = {}
+        self.paths = {}
+        self.probing = set()
+        # packs are scanned from worker threads too
+        self.lock = Lock()
+        self.dirty = False
+        if isfile(PACKS_JSON):
+            with open(PACKS_JSON, "r") as f:
+                self.packs = json.load(f)
+        # don't lose the pending changes on shutdown
+        atexit.register(self.save)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.packs)
+            self.dirty = False
+        # a crash mid-write must not leave a broken file
+        with open(f"{PACKS_JSON}.tmp", "w") as f:
+            f.write(data)
+        replace(f"{PACKS_JSON}.tmp", PACKS_JSON)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(CATALOG_SAVE_TIME)
+            await offload(self.save)
+
+    def scan(self, dirname: str, probe_new: bool = False):
+        old = self.packs.get(dirname, {}).get("tracks", {})
+        tracks = {}
+        with scandir(dirname) as it:
+            for entry in it:
+                # skip hidden files, like glob() does
+                if entry.name.startswith(".") or not entry.is_file():
+                    continue
+                st = entry.stat()
+                track = old.get(entry.name, None)
+                if (
+                    not track
+                    or track["size"] != st.st_size
+                    or track["mtime"] != st.st_mtime
+                ):
+                    track = {
+                        "size": st.st_size,
+                        "mtime": st.st_mtime,
+                    }
+                tracks[entry.name] = track
+
+        if probe_new:
+            # probe all new tracks concurrently
+            names = [name for name, track in tracks.items() if "info" not in track]
+            paths = [join(dirname, name) for name in names]
+            infos = probe_all(paths)
+            with self.lock:
+                for name, info in zip(names, infos):
+                    tracks[name]["info"] = info
+
+        pack = {
+            "mtime": stat(dirname).st_mtime,
+            "tracks": tracks,
+        }
+        with self.lock:
+            self.packs[dirname] = pack
+            self.paths[dirname] = [join(dirname, name) for name in sorted(tracks)]
+            self.dirty = True
+
+    def update(self, dirname: str):
+        # called after modifying the pack, probes all new tracks
+        self.scan(dirname, probe_new=True)
+
+    def remove(self, dirname: str):
+        with self.lock:
+            self.paths.pop(dirname, None)
+            if self.packs.pop(dirname, None):
+                self.dirty = True
+
+    def tracks(self, dirname: str) -> List[str]:
+        try:
+            mtime = stat(dirname).st_mtime
+        except FileNotFoundError:
+            self.remove(dirname)
+            return []
+        pack = self.packs.get(dirname, None)
+        if not pack or pack["mtime"] != mtime:
+            self.scan(dirname)
+        elif dirname not in self.paths:
+            # loaded from PACKS_JSON
+            tracks = sorted(pack["tracks"])
+            self.paths[dirname] = [join(dirname, name) for name in tracks]
+        return self.paths[dirname]
+
+    def track_info(self, filename: str, dirname: str) -> Optional[dict]:
+        pack = self.packs.get(dirname, None)
+        if not pack:
+            return None
+        name = filename[len(join(dirname, "")) :]
+        track = pack["tracks"].get(name, None)
+        if track is None:
+            return None
+        if "info" not in track:
+            # probed once, after the first play
+            with self.lock:
+                if filename in self.probing:
+                    return None
+                self.probing.add(filename)
+            probe_pool.submit(self.probe_track, track, filename)
+            return None
+        return track["info"]
+
+    def probe_track(self, track: dict, filename: str):
+        info = probe(filename)
+        with self.lock:
+            track["info"] = info
+            self.probing.discard(filename)
+            self.dirty = True
+
+    def duration(self, dirname: str) -> float:
+        # only uses the already indexed tracks
+        pack = self.packs.get(dirname, None)
+        if not pack:
+            return 0.0
+        return sum(
+            track["info"]["duration"]
+            for track in pack["tracks"].values()
+            if track.get("info", None)
+        )
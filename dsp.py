@@ -0,0 +1,310 @@
+from functools import lru_cache
+from math import cos, pi, sin, sqrt
+from threading import Lock
+from typing import List, Optional, Tuple
+
+from discord import AudioSource, VoiceClient
+from discord.opus import Decoder, Encoder
+
+from filterchain import (
+    FILTER_BASS,
+    FILTER_TREBLE,
+    FILTER_VOLUME,
+    normalize_filters,
+    parse_filter,
+)
+from utils import find_source
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+# the same defaults as the ffmpeg bass and treble filters
+BASS_FREQ = 100
+TREBLE_FREQ = 3000
+SHELF_Q = 1 / sqrt(2)
+# length of the shelving filters' impulse response
+FIR_LENGTH = 4096
+FFT_SIZE = 8192
+
+# None if not checked yet
+numpy_available: Optional[bool] = None
+
+
+def dsp_available() -> bool:
+    global numpy_available
+    if numpy_available is None:
+        try:
+            import numpy  # noqa
+
+            numpy_available = True
+        except ImportError:
+            numpy_available = False
+    return numpy_available
+
+
+def shelf_biquad(
+    freq: float, gain_db: float, high: bool
+) -> Tuple[List[float], List[float]]:
+    # RBJ Audio EQ Cookbook shelving filter, normalized to a0 = 1
+    a = 10 ** (gain_db / 40)
+    w0 = 2 * pi * freq / SAMPLE_RATE
+    alpha = sin(w0) / (2 * SHELF_Q)
+    c = cos(w0)
+    k = 2 * sqrt(a) * alpha
+    if high:
+        b = [
+            a * ((a + 1) + (a - 1) * c + k),
+            -2 * a * ((a - 1) + (a + 1) * c),
+            a * ((a + 1) + (a - 1) * c - k),
+        ]
+        den = [(a + 1) - (a - 1) * c + k, 2 * ((a - 1) - (a + 1) * c)]
+        den.append((a + 1) - (a - 1) * c - k)
+    else:
+        b = [
+            a * ((a + 1) - (a - 1) * c + k),
+            2 * a * ((a - 1) - (a + 1) * c),
+            a * ((a + 1) - (a - 1) * c - k),
+        ]
+        den = [(a + 1) + (a - 1) * c + k, -2 * ((a - 1) + (a + 1) * c)]
+        den.append((a + 1) + (a - 1) * c - k)
+    return [x / den[0] for x in b], [1.0, den[1] / den[0], den[2] / den[0]]
+
+
+def impulse_response(biquads: List[Tuple[List[float], List[float]]]):
+    import numpy as np
+
+    # the filters decay long before FIR_LENGTH, so the tail aliased by
+    # the inverse transform of the sampled frequency response is negligible
+    size = FFT_SIZE
+    z = np.exp(-2j * pi * np.arange(size // 2 + 1) / size)
+    response = np.ones(size // 2 + 1, dtype=np.complex128)
+    for b, a in biquads:
+        response *= np.polyval(b[::-1], z) / np.polyval(a[::-1], z)
+    return np.fft.irfft(response, size)[0:FIR_LENGTH]
+
+
+class DSPParams:
+    """Gain and shelving filters of DSPAudio, not modified once created."""
+
+    def __init__(self, gain: float = 1.0, bass: float = 0.0, treble: float = 0.0):
+        import numpy as np
+
+        self.gain = gain
+        self.bass = bass
+        self.treble = treble
+        # frequency response of the filters, None if flat
+        self.response = None
+        biquads = []
+        if abs(bass) >= 0.005:
+            biquads.append(shelf_biquad(BASS_FREQ, bass, high=False))
+        if abs(treble) >= 0.005:
+            biquads.append(shelf_biquad(TREBLE_FREQ, treble, high=True))
+        if biquads:
+            ir = impulse_response(biquads).astype(np.float32)
+            self.response = np.fft.rfft(ir, FFT_SIZE)
+
+    def is_identity(self) -> bool:
+        return self.response is None and abs(self.gain - 1.0) < 0.0001
+
+
+@lru_cache(maxsize=256)
+def dsp_params(lines: Tuple[str, ...]) -> DSPParams:
+    gain = 1.0
+    bass = 0.0
+    treble = 0.0
+    for item in map(parse_filter, normalize_filters(list(lines))):
+        if item.kind == FILTER_VOLUME:
+            gain *= item.amount
+        elif item.kind == FILTER_BASS:
+            bass += item.amount
+        elif item.kind == FILTER_TREBLE:
+            treble += item.amount
+    return DSPParams(gain, bass, treble)
+
+
+class DSPAudio(AudioSource):
+    """Applies gain and shelving filters to the decoded audio of a source.
+
+    The filters are applied to 20 ms frames by FFT convolution with
+    overlap-add. Assigning new params takes effect with the next frame,
+    gain changes are ramped over the frame to avoid clicks.
+    """
+
+    def __init__(self, source: AudioSource, params: DSPParams):
+        import numpy as np
+
+        self.np = np
+        self.source = source
+        self.filename = getattr(source, "filename", None)
+        self.params = params
+        self.decoder = Decoder() if source.is_opus() else None
+        self.gain = params.gain
+        # convolution output overlapping the next frames
+        self.tail = np.zeros((FIR_LENGTH - 1, CHANNELS), dtype=np.float32)
+        self.tail_empty = True
+
+    def read(self) -> bytes:
+        data = self.source.read()
+        if not data:
+            return b""
+        if self.decoder:
+            data = self.decoder.decode(data)
+        # params may be replaced from another thread
+        params = self.params
+        if params.is_identity() and self.gain == params.gain and self.tail_empty:
+            return data
+
+        np = self.np
+        x = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+        x = x.reshape(-1, CHANNELS)
+        n = len(x)
+        if params.response is not None:
+            spectrum = np.fft.rfft(x, FFT_SIZE, axis=0) * params.response[:, None]
+            y = np.fft.irfft(spectrum, FFT_SIZE, axis=0)[0 : n + FIR_LENGTH - 1]
+            y[0 : FIR_LENGTH - 1] += self.tail
+            self.tail = y[n:].astype(np.float32)
+            self.tail_empty = False
+            y = y[0:n]
+        elif not self.tail_empty:
+            # the filters were just disabled, play the rest of their output
+            y = x + self.tail[0:n]
+            self.tail = np.concatenate((self.tail[n:], np.zeros_like(x)))
+            self.tail_empty = not self.tail.any()
+        else:
+            y = x
+
+        if self.gain != params.gain:
+            ramp = np.linspace(self.gain, params.gain, n, dtype=np.float32)
+            y = y * ramp[:, None]
+            self.gain = params.gain
+        elif self.gain != 1.0:
+            y = y * self.gain
+        return np.clip(y, -32768, 32767).astype(np.int16).tobytes()
+
+    def is_opus(self) -> bool:
+        return False
+
+    def cleanup(self):
+        self.source.cleanup()
+
+
+class MixerAudio(AudioSource):
+    """Plays short clips over a source, mixing the decoded audio of all of them.
+
+    The source is ducked while any clips are playing. Without clips, Opus
+    packets of the source are passed through without decoding. The mixer
+    ends with the source, cleaning up the clips which are still playing.
+    """
+
+    def __init__(self, source: AudioSource, ducking: float = 1.0, limit: int = 4):
+        import numpy as np
+
+        self.np = np
+        self.source = source
+        self.filename = getattr(source, "filename", None)
+        self.ducking = ducking
+        self.limit = limit
+        # [(source, decoder, gain)], added from the event loop
+        self.clips: List[Tuple[AudioSource, Optional[Decoder], float]] = []
+        self.lock = Lock()
+        self.source_opus = source.is_opus()
+        # created when mixing starts, passed through packets aren't decoded
+        self.decoder: Optional[Decoder] = None
+        self.gain = 1.0
+        # limiter gain, recovering after loud frames
+        self.limiter = 1.0
+        # format of the last returned frame
+        self.opus = source.is_opus()
+
+    def add(self, source: AudioSource, gain: float = 1.0):
+        decoder = Decoder() if source.is_opus() else None
+        with self.lock:
+            if len(self.clips) >= self.limit:
+                # make room by stopping the oldest clip
+                oldest, _, _ = self.clips.pop(0)
+                oldest.cleanup()
+            self.clips.append((source, decoder, gain))
+
+    def read_pcm(self, source: AudioSource, decoder: Optional[Decoder]):
+        data = source.read()
+        if not data:
+            return None
+        if decoder:
+            data = decoder.decode(data)
+        return self.np.frombuffer(data, dtype=self.np.int16).reshape(-1, CHANNELS)
+
+    def read(self) -> bytes:
+        with self.lock:
+            clips = list(self.clips)
+        if not clips and self.gain == 1.0 and self.limiter == 1.0:
+            self.decoder = None
+            self.opus = self.source_opus
+            return self.source.read()
+
+        np = self.np
+        if self.source_opus and not self.decoder:
+            self.decoder = Decoder()
+        main = self.read_pcm(self.source, self.decoder)
+        if main is None:
+            return b""
+        y = main.astype(np.float32)
+        n = len(y)
+        gain = self.ducking if clips else 1.0
+        if self.gain != gain:
+            y *= np.linspace(self.gain, gain, n, dtype=np.float32)[:, None]
+            self.gain = gain
+        elif gain != 1.0:
+            y *= gain
+
+        finished = []
+        for clip in clips:
+            source, decoder, clip_gain = clip
+            pcm = self.read_pcm(source, decoder)
+            if pcm is None:
+                finished.append(clip)
+                continue
+            m = min(n, len(pcm))
+            y[0:m] += pcm[0:m] * clip_gain
+        if finished:
+            with self.lock:
+                self.clips = [clip for clip in self.clips if clip not in finished]
+            for source, _, _ in finished:
+                source.cleanup()
+
+        # lower the gain of loud frames instead of clipping them,
+        # recovering over a few frames afterwards
+        peak = float(np.abs(y).max())
+        required = 32767 / peak if peak > 32767 else 1.0
+        if required < self.limiter:
+            y *= required
+            self.limiter = required
+        elif self.limiter < 1.0:
+            target = min(required, self.limiter + 0.05)
+            y *= np.linspace(self.limiter, target, n, dtype=np.float32)[:, None]
+            self.limiter = target
+        self.opus = False
+        return np.clip(y, -32768, 32767).astype(np.int16).tobytes()
+
+    def is_opus(self) -> bool:
+        # the player checks the format after reading every frame
+        return self.opus
+
+    def cleanup(self):
+        with self.lock:
+            clips, self.clips = self.clips, []
+        for source, _, _ in clips:
+            source.cleanup()
+        self.source.cleanup()
+
+
+def attach_mixer(voice: VoiceClient, ducking: float, limit: int) -> MixerAudio:
+    # mix clips into the playing source of the voice client
+    mixer = find_source(voice.source, MixerAudio)
+    if mixer:
+        return mixer
+    # the player only creates an encoder if the first source isn't Opus,
+    # but the mixer returns PCM while clips are playing
+    if not voice.encoder:
+        voice.encoder = Encoder()
+    mixer = MixerAudio(voice.source, ducking, limit)
+    voice.source = mixer
+    return mixer
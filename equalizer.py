@@ -1,23 +1,24 @@
 import re
 from math import log
-from typing import Dict, List
+from typing import List
 
 from discord.ext import commands
 from discord.ext.commands import Bot, Cog, Context
 
 from espionage import Espionage
-from settings import COG_EQUALIZER, COG_ESPIONAGE
+from filterchain import normalize_filters
+from settings import COG_EQUALIZER, COG_ESPIONAGE, FILTER_CHAIN_LIMIT
+from storage import Storage
 from utils import (
     check_playing_cmd,
     ensure_command,
     ensure_playing,
     normalize_percent,
-    save_files,
 )
 
 
 class Equalizer(Cog, name=COG_EQUALIZER):
-    def __init__(self, bot: Bot, files: Dict[str, dict], sf2s: Dict[str, str]):
+    def __init__(self, bot: Bot, files: Storage, sf2s: Storage):
         self.bot = bot
         self.files = files
         self.espionage: Espionage = self.bot.get_cog(COG_ESPIONAGE)
@@ -52,12 +53,22 @@ class Equalizer(Cog, name=COG_EQUALIZER):
     async def add_filter(self, ctx: Context, title: str, value: str):
         (name,) = await check_playing_cmd(ctx, self.espionage, None)
         cmd = await ensure_command(ctx, name, self.files)
-        # add the filter
-        if "filters" not in cmd:
-            cmd["filters"] = []
-        cmd["filters"].append(f"{title}#{value}")
-        # save the command descriptors
-        save_files(self.files)
+        old_filters = cmd.get("filters", [])
+        # add the filter, merging it with the previous one if possible
+        filters = normalize_filters(cmd.get("filters", []) + [f"{title}#{value}"])
+        if len(filters) > FILTER_CHAIN_LIMIT:
+            await ctx.send(
+                f":x: `!{name}` can't have more than {FILTER_CHAIN_LIMIT} filters.\n"
+                "Use `!eq reset` to clear all filters.",
+                delete_after=3,
+            )
+            return
+        if filters:
+            cmd["filters"] = filters
+        else:
+            cmd.pop("filters", None)
+        # save the command descriptor
+        self.files.save(name)
 
         await ctx.send(
             f":v: Filter `{title}` added to `!{name}`.\n"
@@ -65,7 +76,7 @@ class Equalizer(Cog, name=COG_EQUALIZER):
         )
 
         if ctx.guild and ctx.guild.voice_client:
-            self.espionage.reload(guild=ctx.guild)
+            self.espionage.update_filters(ctx.guild, old_filters)
 
     @eq.command()
     async def help(self, ctx: Context):
@@ -78,10 +89,11 @@ class Equalizer(Cog, name=COG_EQUALIZER):
         """Reset all filters (effects)."""
         (name,) = await check_playing_cmd(ctx, self.espionage, None)
         cmd = await ensure_command(ctx, name, self.files)
+        old_filters = cmd.get("filters", [])
         # clear all filters
         cmd.pop("filters", None)
-        # save the command descriptors
-        save_files(self.files)
+        # save the command descriptor
+        self.files.save(name)
 
         await ctx.send(
             f":v: Cleared all filters of `!{name}`.\n"
@@ -89,7 +101,7 @@ class Equalizer(Cog, name=COG_EQUALIZER):
         )
 
         if ctx.guild and ctx.guild.voice_client:
-            self.espionage.reload(guild=ctx.guild)
+            self.espionage.update_filters(ctx.guild, old_filters)
 
     @eq.command()
     @commands.before_invoke(ensure_playing)
@@ -1,63 +1,237 @@
 import asyncio
 from asyncio import Task
-from glob import glob
-from os.path import isfile, relpath
+from itertools import chain
+from os.path import basename, isfile, relpath
 from random import choice as random_choice
 from time import time
-from typing import Dict, Optional, Set
-
-from discord import Guild, Member, User, VoiceChannel, VoiceClient, VoiceState
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from discord import (
+    AudioSource,
+    Guild,
+    Member,
+    User,
+    VoiceChannel,
+    VoiceClient,
+    VoiceState,
+)
 from discord.ext import commands
 from discord.ext.commands import Bot, Cog, Command, Context
 
+from catalog import PackCatalog
+from dsp import DSPAudio, attach_mixer, dsp_available, dsp_params
+from filterchain import (
+    compile_filters,
+    ffmpeg_filters,
+    loudness_filters,
+    played_duration,
+    seek_filters,
+)
+from playlog import PlayLog, PlayRecord, read_all, read_csv_records
+from search import command_search
 from settings import (
     COG_ESPIONAGE,
+    COMMAND_ROUTER,
     ESPIONAGE_FILE,
-    LOG_CSV,
     MIDI_IMPL,
     MIDI_IMPL_NONE,
+    NORMALIZE_LOUDNESS,
+    OVERLAY_DUCKING,
+    OVERLAY_LIMIT,
+    OVERLAY_MAX_DURATION,
     PACK_ICON,
+    PREFETCH_TIME,
     RANDOM_FILE,
+    RANDOM_MODE_DURATION,
+    RANDOM_MODE_PLAYS,
+    RANDOM_MODE_UNIFORM,
+    STATS_SAVE_TIME,
     UPLOAD_PATH,
 )
+from stats import STATS_COMMAND, PlayStats, backfill_stats
+from storage import Storage
 from utils import (
+    AliasTable,
+    BufferedAudio,
+    ClockedAudio,
     FFmpegFileOpusAudio,
     FFmpegMidiOpusAudio,
+    OpusPacketAudio,
+    PrefetchInfo,
     ReplayInfo,
+    ShuffleBag,
     connect_to,
     disconnect,
     ensure_voice,
+    find_source,
     is_alone,
+    load_packet_store,
+    offload,
+    opus_filename,
+    original_filename,
+    prepare_file_rendition,
+    print_offload_times,
     real_filename,
 )
+from variants import VariantCache
+
+# assumed duration of music packs and files without audio info
+PACK_DURATION = 60.0
+
+
+class CommandRouter(dict):
+    """Bot commands, falling back to audio commands created on lookup.
+
+    Replaces Bot.all_commands, so that the command parser and !help
+    resolve audio commands without registering a Command for each file.
+    """
+
+    def __init__(self, all_commands: Dict[str, Command], espionage: "Espionage"):
+        super().__init__(all_commands)
+        self.espionage = espionage
+
+    def get(self, name: str, default=None):
+        command = super().get(name, None)
+        if command is not None:
+            return command
+        if name in self.espionage.files:
+            return self.espionage.create_command(name)
+        return default
 
 
 class Espionage(Cog, name=COG_ESPIONAGE):
-    # {guild_id: {...filename}}
-    random_queue: Dict[int, Set[str]]
+    # {guild_id: {RANDOM_FILE or pack dirname: ShuffleBag}}
+    random_queue: Dict[int, Dict[str, ShuffleBag]]
     # {guild_id: ReplayInfo}
     replay_info: Dict[int, ReplayInfo]
     # {channel_id: Task}
     empty_task: Dict[int, Task]
     # {channel_id}
     empty_id: Set[int]
-
-    def __init__(self, bot: Bot, files: Dict[str, dict], sf2s: Dict[str, str]):
+    # {guild_id: RANDOM_MODE_*}
+    random_mode: Dict[int, str]
+    # {RANDOM_MODE_*: AliasTable}
+    alias_tables: Dict[str, AliasTable]
+    # {guild_id: PrefetchInfo}
+    prefetched: Dict[int, PrefetchInfo]
+    # {guild_id: Task}
+    prefetch_task: Dict[int, Task]
+
+    def __init__(self, bot: Bot, files: Storage, sf2s: Storage):
         self.bot = bot
         self.files = files
         self.sf2s = sf2s
         self.bot.event(self.on_voice_state_update)
-        for name in files.keys():
-            self.add_command(name)
         self.random_queue = {}
         self.replay_info = {}
         self.empty_task = {}
         self.empty_id = set()
+        self.random_mode = {}
+        self.alias_tables = {}
+        self.prefetched = {}
+        self.prefetch_task = {}
+        # {guild_id: asyncio.Lock}, keeps the order of repeat() calls
+        self.play_locks = {}
+        self.espionage_opus = prepare_file_rendition(ESPIONAGE_FILE)
+        self.catalog = PackCatalog()
+        self.variants = VariantCache()
+        self.play_log = PlayLog()
+        self.play_log_task = None
+        self.catalog_task = None
+        self.stats = PlayStats(files.db)
+        self.stats_task = None
+        for name in files.keys():
+            self.index_command(name)
+        if COMMAND_ROUTER:
+            # resolve audio commands on demand instead of registering them
+            self.bot.all_commands = CommandRouter(self.bot.all_commands, self)
+        else:
+            for name in files.keys():
+                self.add_command(name)
         print(f"Loaded {len(files)} audio commands.")
 
+    async def cog_load(self):
+        self.play_log_task = asyncio.create_task(self.play_log.run())
+        self.stats_task = asyncio.create_task(self.save_stats())
+        self.catalog_task = asyncio.create_task(self.catalog.run())
+
+    async def cog_unload(self):
+        self.play_log_task.cancel()
+        self.stats_task.cancel()
+        self.catalog_task.cancel()
+        await offload(self.play_log.flush)
+        await offload(self.catalog.save)
+        self.stats.save()
+        print_offload_times()
+
+    async def save_stats(self):
+        if self.stats.backfill_until is not None:
+            await self.backfill_stats()
+        while True:
+            await asyncio.sleep(STATS_SAVE_TIME)
+            self.stats.save()
+
+    async def backfill_stats(self):
+        # count the plays logged before the stats existed
+        by_file = {cmd["filename"]: name for name, cmd in self.files.items()}
+
+        def resolve(record: PlayRecord) -> Tuple[Optional[str], float]:
+            # !random is logged as "random", find the command by its file
+            name = by_file.get(record.filename, None)
+            if not name:
+                name = by_file.get(record.filename.replace("\\", "/").split("/")[0])
+            if not name and record.cmd not in ["None", RANDOM_FILE]:
+                name = record.cmd
+            cmd = self.files.get(name, None)
+            if not cmd:
+                return name, 0.0
+            if "pack" in cmd and cmd["pack"]:
+                # don't probe the tracks, only use the indexed ones
+                pack = self.catalog.packs.get(real_filename(cmd), {})
+                track = pack.get("tracks", {}).get(basename(record.filename), {})
+                info = track.get("info", None)
+            else:
+                info = cmd.get("info", None)
+            duration = (info or {}).get("duration", None) or 0.0
+            return name, duration * 100 / (record.speed or 100)
+
+        records = chain(read_csv_records(), read_all())
+        # later plays are counted live
+        until = self.stats.backfill_until
+        stats, count = await offload(backfill_stats, records, resolve, until)
+        self.stats.merge(stats)
+        self.stats.save(backfilled=True)
+        # the play counts changed
+        self.invalidate_weights()
+        print(f"Added {count} logged plays to the stats.")
+
+    def index_command(self, name: str):
+        cmd = self.files[name]
+        filenames = [cmd.get("original", None) or original_filename(cmd["filename"])]
+        if "pack" in cmd and cmd["pack"]:
+            tracks = self.catalog.tracks(real_filename(cmd))
+            filenames += [original_filename(track) for track in tracks]
+        command_search.add(name, cmd, filenames)
+
     def add_command(self, name: str):
-        if self.bot.get_command(name):
+        # update the command in !find
+        self.index_command(name)
+        # make the command available in !random
+        self.update_weights(name)
+        for bags in self.random_queue.values():
+            if RANDOM_FILE in bags:
+                bags[RANDOM_FILE].add(name)
+        if COMMAND_ROUTER or self.bot.get_command(name):
+            return
+        self.bot.add_command(self.create_command(name))
+
+    def remove_command(self, name: str):
+        command_search.remove(name)
+        if COMMAND_ROUTER or not self.bot.get_command(name):
             return
+        self.bot.remove_command(name)
+
+    def describe(self, name: str) -> str:
         cmd = self.files[name]
         description = cmd["help"]
         if "pack" in cmd and cmd["pack"]:
@@ -66,21 +240,23 @@ class Espionage(Cog, name=COG_ESPIONAGE):
             description = (
                 f"Loop {cmd['filename']}" if cmd["loop"] else f"Play {cmd['filename']}"
             )
-        command: Command = self.bot.command(
+        return description
+
+    def create_command(self, name: str) -> Command:
+        command: Command = commands.command(
             name=name,
-            brief=description,
+            brief=self.describe(name),
         )(self.play_command)
         command.before_invoke(ensure_voice)
         command.cog = self
-
-    def remove_command(self, name: str):
-        if not self.bot.get_command(name):
-            return
-        self.bot.remove_command(name)
+        return command
 
     @commands.guild_only()
     async def play_command(self, _, ctx: Context, __: User = None):
         cmd = ctx.command.name
+        # short clips are played over the current track
+        if await self.overlay(ctx.guild, ctx.message.author, cmd):
+            return
         # force playing the specified file
         await self.play(
             channel=ctx.voice_client.channel,
@@ -201,43 +377,171 @@ class Espionage(Cog, name=COG_ESPIONAGE):
         print(f"Updating nickname on '{guild.name}': '{current_nick}' -> '{new_nick}'")
         await me.edit(nick=new_nick)
 
-    def safe_random(self, guild_id: int, items: list):
-        if guild_id not in self.random_queue:
-            queue = self.random_queue[guild_id] = set()
-        else:
-            queue = self.random_queue[guild_id]
-
-        def key(item) -> str:
-            if isinstance(item, dict):
-                return item["filename"]
-            if isinstance(item, tuple):
-                return item[1]["filename"]
-            return item
-
-        # reset the queue if all choices were played
-        if all(key(item) in queue for item in items):
-            for item in items:
-                queue.remove(key(item))
-
-        # failsafe
-        random_item = random_choice(items)
-        # pick a random item that wasn't used before
-        while len(items) > 0:
-            item = random_choice(items)
-            items.remove(item)
-            if key(item) not in queue:
-                queue.add(key(item))
+    def get_bag(self, guild_id: int, key: str) -> ShuffleBag:
+        bags = self.random_queue.setdefault(guild_id, {})
+        if key not in bags:
+            bags[key] = ShuffleBag(self.files.keys() if key == RANDOM_FILE else ())
+        return bags[key]
+
+    def get_weight(self, mode: str, name: str, cmd: dict) -> float:
+        # admin-set weight applies to all weighted modes
+        weight = cmd.get("weight", 1.0)
+        if mode == RANDOM_MODE_DURATION:
+            if "pack" in cmd and cmd["pack"]:
+                duration = self.catalog.duration(real_filename(cmd))
+            else:
+                duration = cmd.get("info", {}).get("duration", 0.0)
+            weight *= max(duration or PACK_DURATION, 1.0)
+        elif mode == RANDOM_MODE_PLAYS:
+            weight *= self.stats.plays(STATS_COMMAND, name) + 1
+        return weight
+
+    def invalidate_weights(self):
+        # tables are rebuilt on the next weighted pick
+        self.alias_tables.clear()
+
+    def update_weights(self, name: str):
+        # update a changed, added or removed command in the built tables
+        cmd = self.files.get(name, None)
+        for mode, table in self.alias_tables.items():
+            if cmd:
+                table.set(name, self.get_weight(mode, name, cmd))
+            else:
+                table.remove(name)
+
+    def weighted_random(self, guild_id: int) -> Optional[str]:
+        mode = self.random_mode.get(guild_id, RANDOM_MODE_UNIFORM)
+        if mode == RANDOM_MODE_UNIFORM:
+            return self.safe_random(guild_id)
+
+        table = self.alias_tables.get(mode, None)
+        if not table:
+            weights = {
+                name: self.get_weight(mode, name, cmd)
+                for name, cmd in self.files.items()
+            }
+            table = self.alias_tables[mode] = AliasTable(weights)
+
+        # keep the no-repeat guarantee of the guild's shuffle bag
+        bag = self.get_bag(guild_id, RANDOM_FILE)
+        for _ in range(16):
+            name = table.sample()
+            if name not in self.files:
+                # removed after building the table
+                self.update_weights(name)
+                break
+            if name in bag and not bag.is_picked(name):
+                bag.take(name)
+                return name
+        # fall back to the uniformly picked remainder of the round
+        return self.safe_random(guild_id)
+
+    def safe_random(
+        self,
+        guild_id: int,
+        key: str = RANDOM_FILE,
+        items: List[str] = None,
+    ) -> Optional[str]:
+        # RANDOM_FILE picks commands, other keys pick from the given items
+        bag = self.get_bag(guild_id, key)
+        if items is not None:
+            bag.update(items)
+
+        while len(bag):
+            item = bag.pick()
+            if key != RANDOM_FILE or item in self.files:
                 return item
-        # failsafe
-        return random_item
+            # the command was removed in the meantime
+            bag.remove(item)
+        return None
 
     async def play(self, channel: VoiceChannel, member: Member, cmd: str):
         # connect to the specified voice channel
         await connect_to(channel)
         # repeat the file
-        self.repeat(channel, member, cmd)
+        await self.play_next(channel, member, cmd)
+
+    async def overlay(self, guild: Guild, member: Member, cmd_name: str) -> bool:
+        # play a clip without stopping the current track, if it's short enough
+        voice: VoiceClient = guild.voice_client
+        replay_info = self.replay_info.get(guild.id, None)
+        if not OVERLAY_MAX_DURATION or not dsp_available():
+            return False
+        if not voice or not voice.is_playing() or not replay_info:
+            return False
+        # the same command restarts, the default file is replaced
+        if not replay_info.cmd_name or replay_info.cmd_orig == cmd_name:
+            return False
+        cmd = self.files.get(cmd_name, None)
+        if not cmd or cmd["loop"] or cmd.get("pack", False) or cmd.get("midi", False):
+            return False
+        info = cmd.get("info", None)
+        filters, extra_opts, speed, _ = self.get_filters(cmd, 0.0, info)
+        duration = played_duration(info)
+        if not duration or duration * 100 / speed > OVERLAY_MAX_DURATION:
+            return False
+        filename = real_filename(cmd)
+        if not await offload(isfile, filename):
+            return False
+
+        def open_clip() -> Optional[AudioSource]:
+            source, _ = self.create_source(
+                cmd, filename, filters, extra_opts, 0.0, pack=False, gapless=False
+            )
+            return source
+
+        source = await offload(open_clip)
+        if not source:
+            return False
+        # the track might have ended in the meantime
+        if not voice.is_playing():
+            source.cleanup()
+            return False
+        mixer = attach_mixer(voice, OVERLAY_DUCKING, OVERLAY_LIMIT)
+        mixer.add(source)
+
+        self.log_play(guild, member, cmd_name, cmd_name, filename, info, speed)
+        print(
+            f"Overlaying command '{cmd_name}', file '{filename}' "
+            f"on {guild} - "
+            f"speed: {speed}%, "
+            f"filters: {','.join(filters)}, "
+            f"extra opts: {' '.join(extra_opts)}"
+        )
+        return True
 
-    def reload(self, guild: Guild):
+    def log_play(
+        self,
+        guild: Guild,
+        member: Member,
+        cmd_orig: Optional[str],
+        cmd_name: Optional[str],
+        filename: str,
+        info: Optional[dict],
+        speed: int,
+    ):
+        # written to PLAY_LOG in the background
+        record = PlayRecord(
+            timestamp=int(time()),
+            guild_id=guild.id,
+            guild_name=guild.name,
+            member_id=member.id,
+            member_name=f"{member.name}#{member.discriminator}",
+            cmd=cmd_orig or "None",
+            filename=relpath(filename, UPLOAD_PATH),
+            speed=int(speed),
+        )
+        self.play_log.add(record)
+        if cmd_name:
+            duration = (info or {}).get("duration", None) or 0.0
+            self.stats.add(record, cmd_name, duration * 100 / speed)
+            # also for the commands picked by !random
+            table = self.alias_tables.get(RANDOM_MODE_PLAYS, None)
+            if table and cmd_name in self.files:
+                cmd = self.files[cmd_name]
+                table.set(cmd_name, self.get_weight(RANDOM_MODE_PLAYS, cmd_name, cmd))
+
+    def reload(self, guild: Guild, start: Optional[float] = None):
         if guild.id in self.replay_info:
             # restart the currently playing file
             replay_info = self.replay_info.pop(guild.id)
@@ -246,22 +550,265 @@ class Espionage(Cog, name=COG_ESPIONAGE):
                 member=replay_info.member,
                 cmd=None,
                 repeated=False,
+                start=start,
                 replay_info=replay_info,
             )
 
+    def seek(self, guild: Guild, position: float):
+        # play from 'position' seconds of the file, at normal speed
+        replay_info = self.replay_info.get(guild.id, None)
+        if not replay_info:
+            return
+        playing = guild.voice_client and guild.voice_client.source
+        source = find_source(playing, OpusPacketAudio)
+        if source:
+            # packets are indexed, no need to restart the playback
+            start = position * 100.0 / replay_info.speed
+            source.seek(start)
+            # a prefetched track still has packets from the old position
+            buffered = find_source(playing, BufferedAudio)
+            if buffered:
+                buffered.clear()
+            replay_info.clock.start = start
+            replay_info.clock.frames = 0
+            return
+        self.reload(guild, start=position)
+
+    def update_filters(self, guild: Guild, old_filters: List[str]):
+        # apply the changed filters of the playing command,
+        # without restarting ffmpeg if only the DSP stage is affected
+        replay_info = self.replay_info.get(guild.id, None)
+        if not replay_info:
+            return
+        cmd = replay_info.cmd
+        filters = cmd.get("filters", []) if isinstance(cmd, dict) else []
+        if dsp_available() and ffmpeg_filters(old_filters) == ffmpeg_filters(filters):
+            params = dsp_params(tuple(filters))
+            if replay_info.dsp:
+                # takes effect with the next frame
+                replay_info.dsp.params = params
+                return
+            if params.is_identity():
+                return
+        self.reload(guild)
+
+    def update_loop(self, name: str):
+        # apply a changed loop mode to guilds which are playing the command
+        for replay_info in list(self.replay_info.values()):
+            if replay_info.cmd_name != name or replay_info.cmd_orig == RANDOM_FILE:
+                continue
+            guild = replay_info.channel.guild
+            source = guild.voice_client and guild.voice_client.source
+            source = find_source(source, (OpusPacketAudio, FFmpegFileOpusAudio))
+            if isinstance(source, OpusPacketAudio):
+                # takes effect at the end of the current iteration
+                source.loop = replay_info.cmd["loop"]
+            elif isinstance(source, FFmpegFileOpusAudio):
+                # the input loop can't be changed in a running ffmpeg
+                self.reload(guild)
+
     def leave(self, voice: VoiceClient):
+        self.bot.loop.call_soon_threadsafe(self.schedule_prefetch, voice.guild.id)
         self.bot.loop.create_task(disconnect(voice))
         self.bot.loop.create_task(self.update_nickname(voice.guild, None))
         self.replay_info.pop(voice.guild.id, None)
 
+    def file_info(self, cmd: Union[dict, str], filename: str) -> Optional[dict]:
+        if not isinstance(cmd, dict):
+            return None
+        if "pack" in cmd and cmd["pack"]:
+            return self.catalog.track_info(filename, real_filename(cmd))
+        return cmd.get("info", None)
+
+    @staticmethod
+    def get_filters(
+        cmd: Union[dict, str],
+        start: float,
+        info: Optional[dict] = None,
+    ) -> Tuple[List[str], List[str], int, float]:
+        filters = []
+        extra_opts = []
+        if isinstance(cmd, dict):
+            midi = "midi" in cmd and cmd["midi"]
+            speed: int
+            speed = cmd["speed"] if "speed" in cmd else 100
+            if speed != 100 and start:
+                # adjust starting position for the current playback speed
+                start = start / (speed / 100.0)
+            # 44100 Hz for MIDI and files without audio info
+            rate = info["sample_rate"] if info else 44100
+            # volume, bass and treble are applied by the DSP stage if possible
+            filters, extra_opts = compile_filters(
+                tuple(cmd.get("filters", [])), speed, rate, midi, dsp_available()
+            )
+            filters, extra_opts = list(filters), list(extra_opts)
+            if NORMALIZE_LOUDNESS and info and not midi:
+                filters = loudness_filters(info) + filters
+        else:
+            speed = 100
+        return filters, extra_opts, speed, start
+
+    def create_source(
+        self,
+        cmd: Union[dict, str],
+        filename: str,
+        filters: List[str],
+        extra_opts: List[str],
+        start: float,
+        pack: bool,
+        gapless: bool,
+    ) -> Tuple[Optional[AudioSource], str]:
+        extra_info = ""
+        midi = isinstance(cmd, dict) and "midi" in cmd and cmd["midi"]
+        if midi:
+            sf2s = cmd["sf2s"]
+            sf2 = random_choice(sf2s) if sf2s else None
+            sf2s = list(self.sf2s.values())
+            if not sf2s or MIDI_IMPL == MIDI_IMPL_NONE:
+                return None, extra_info
+            sf2 = self.sf2s[sf2] if sf2 in self.sf2s else random_choice(sf2s)
+            sf2_name = real_filename(sf2)
+            extra_info = f"with SF2 '{sf2_name}' "
+            source = FFmpegMidiOpusAudio(filename, sf2_name, filters, extra_opts, start)
+        else:
+            # play the Opus rendition with codec copy if no filters are applied
+            # besides the loudness adjustments it was transcoded with
+            opus = None
+            baked = isinstance(cmd, dict) and filters == cmd.get("opus_filters", [])
+            if baked and not pack and not extra_opts:
+                opus = opus_filename(cmd)
+            elif isinstance(cmd, dict) and not pack:
+                # filters are applied once, when rendering the variant
+                opus, rendering = self.variants.get(cmd, filename, filters, extra_opts)
+                if opus:
+                    extra_info = "pre-rendered "
+                if rendering:
+                    # repeat() picks the variant up after it's rendered
+                    gapless = False
+            elif filename == ESPIONAGE_FILE:
+                opus = self.espionage_opus
+            store = opus and load_packet_store(opus)
+            if store:
+                # share the memory-mapped packets between all guilds
+                extra_info += "from packet store "
+                source = OpusPacketAudio(store, start, loop=gapless)
+            elif opus:
+                extra_info += "with Opus passthrough "
+                source = FFmpegFileOpusAudio(
+                    opus, [], [], start, loop=gapless, codec="opus"
+                )
+            elif gapless or not start:
+                source = FFmpegFileOpusAudio(
+                    filename, filters, extra_opts, start, loop=gapless
+                )
+            else:
+                # seek the input instead of decoding everything before 'start'
+                speed = cmd.get("speed", 100) if isinstance(cmd, dict) else 100
+                filters, seek = seek_filters(filters, start * speed / 100.0)
+                source = FFmpegFileOpusAudio(
+                    filename, filters, extra_opts, 0.0, seek=seek
+                )
+        if isinstance(cmd, dict) and dsp_available():
+            params = dsp_params(tuple(cmd.get("filters", [])))
+            if not params.is_identity():
+                extra_info += "with DSP "
+                source = DSPAudio(source, params)
+        return source, extra_info
+
+    def schedule_prefetch(self, guild_id: int, cmd: str = None, delay: float = 0.0):
+        # drop the previously prepared track
+        prefetch = self.prefetched.pop(guild_id, None)
+        if prefetch:
+            prefetch.source.cleanup()
+        if not cmd:
+            self.prefetch_task.pop(guild_id, None)
+            return
+        # outdated tasks exit by themselves
+        self.prefetch_task[guild_id] = asyncio.create_task(
+            self.prefetch(guild_id, cmd, delay)
+        )
+
+    async def prefetch(self, guild_id: int, cmd_orig: str, delay: float):
+        await asyncio.sleep(delay)
+        if self.prefetch_task.get(guild_id, None) is not asyncio.current_task():
+            return
+
+        if cmd_orig == RANDOM_FILE:
+            cmd_name = self.weighted_random(guild_id)
+        else:
+            cmd_name = cmd_orig
+        if cmd_name not in self.files:
+            return
+        cmd = self.files[cmd_name]
+        pack = "pack" in cmd and cmd["pack"]
+        filename = real_filename(cmd)
+        if pack:
+            tracks = await offload(self.catalog.tracks, filename)
+            filename = self.safe_random(guild_id, filename, tracks)
+        if not filename or not await offload(isfile, filename):
+            return
+        info = await offload(self.file_info, cmd, filename)
+        filters, extra_opts, _, _ = self.get_filters(cmd, 0.0, info)
+
+        def warm_up() -> Optional[BufferedAudio]:
+            # spawn the process and wait for the first packet
+            source, _ = self.create_source(
+                cmd, filename, filters, extra_opts, 0.0, pack, gapless=False
+            )
+            return source and BufferedAudio(source)
+
+        source = await offload(warm_up)
+        if not source:
+            return
+        if self.prefetch_task.get(guild_id, None) is not asyncio.current_task():
+            source.cleanup()
+            return
+        self.prefetch_task.pop(guild_id, None)
+        print(f"Prefetched command '{cmd_name}', file '{filename}'")
+        self.prefetched[guild_id] = PrefetchInfo(
+            cmd=cmd,
+            cmd_name=cmd_name,
+            cmd_orig=cmd_orig,
+            filename=filename,
+            source=source,
+        )
+
     def repeat(
         self,
         channel: VoiceChannel,
         member: Member,
         cmd: Optional[str],
         repeated: bool = False,
-        start: float = 0.0,
+        start: Optional[float] = None,
         replay_info: ReplayInfo = None,
+    ):
+        # called from the player thread too, the files are looked up
+        # in worker threads before playing
+        coro = self.play_next(channel, member, cmd, repeated, start, replay_info)
+        self.bot.loop.call_soon_threadsafe(self.bot.loop.create_task, coro)
+
+    async def play_next(
+        self,
+        channel: VoiceChannel,
+        member: Member,
+        cmd: Optional[str],
+        repeated: bool = False,
+        start: Optional[float] = None,
+        replay_info: ReplayInfo = None,
+    ):
+        # the calls of a guild start playing in the order they were made
+        lock = self.play_locks.setdefault(channel.guild.id, asyncio.Lock())
+        async with lock:
+            await self.start_playing(channel, member, cmd, repeated, start, replay_info)
+
+    async def start_playing(
+        self,
+        channel: VoiceChannel,
+        member: Member,
+        cmd: Optional[str],
+        repeated: bool,
+        start: Optional[float],
+        replay_info: Optional[ReplayInfo],
     ):
         # get the currently connected voice client
         voice: VoiceClient = channel.guild.voice_client
@@ -273,16 +820,26 @@ class Espionage(Cog, name=COG_ESPIONAGE):
 
         # calculate starting offset from ReplayInfo
         if replay_info:
-            # 'timestamp' is calculated starting timestamp at previous rate
-            # 'start' is new starting offset in the file at normal rate
-            rate = 100.0 / replay_info.speed
-            played = time() - replay_info.timestamp
-            start = played / rate
+            # 'start' is new starting offset in the file at normal rate,
+            # counted from the frames played at the previous speed
+            if start is None:
+                start = replay_info.position()
+            # looping sources don't restart, wrap the offset around
+            info = await offload(self.file_info, replay_info.cmd, replay_info.filename)
+            duration = played_duration(info)
+            if duration:
+                start %= duration
             print(
                 f"Reloading playback on '{channel.guild.name}' - "
-                f"was playing for {played:.02f} s "
+                f"played {replay_info.clock.frames} frames "
                 f"at {replay_info.speed}%, now starting at {start:.02f} s"
             )
+        start = start or 0.0
+
+        # take the next track prepared before the previous one ended
+        prefetch = self.prefetched.get(guild_id, None)
+        if prefetch and (not repeated or replay_info or prefetch.cmd_orig != cmd):
+            prefetch = None
 
         # store cmd for usage in repeat(e)
         cmd_orig = cmd
@@ -299,9 +856,16 @@ class Espionage(Cog, name=COG_ESPIONAGE):
             cmd_name = replay_info.cmd_name
             cmd_orig = replay_info.cmd_orig
             random = cmd == RANDOM_FILE
+        elif prefetch:
+            cmd = prefetch.cmd
+            cmd_name = prefetch.cmd_name
         elif random:
             # "random" specified as cmd, change to a random command dict
-            cmd_name, cmd = self.safe_random(guild_id, list(self.files.items()))
+            cmd_name = self.weighted_random(guild_id)
+            if not cmd_name:
+                self.leave(voice)
+                return
+            cmd = self.files[cmd_name]
         elif cmd and cmd != ESPIONAGE_FILE:
             # retrieve command info dict
             cmd_name = cmd
@@ -314,17 +878,23 @@ class Espionage(Cog, name=COG_ESPIONAGE):
         if isinstance(cmd, dict):
             # filename is a basename
             pack = "pack" in cmd and cmd["pack"]
-            if not replay_info:
+            if replay_info:
+                filename = replay_info.filename
+            elif prefetch:
+                filename = prefetch.filename
+            else:
                 filename = real_filename(cmd)
                 if pack:
-                    filename = self.safe_random(guild_id, glob(f"{filename}/*"))
-            else:
-                filename = replay_info.filename
+                    tracks = await offload(self.catalog.tracks, filename)
+                    filename = self.safe_random(guild_id, filename, tracks)
             loop = cmd["loop"] or random or pack
+            # the same file is played again - keep the pipeline running
+            gapless = cmd["loop"] and not random and not pack
         else:
             # only for ESPIONAGE_FILE as cmd - already absolute or relative to cwd
             filename = cmd
             loop = True
+            gapless = True
 
         def leave(e):
             self.leave(voice)
@@ -332,7 +902,7 @@ class Espionage(Cog, name=COG_ESPIONAGE):
         def repeat(e):
             self.repeat(channel, member, cmd=cmd_orig, repeated=True)
 
-        if not isfile(filename):
+        if not filename or not await offload(isfile, filename):
             print("FILE DOES NOT EXIST", filename)
             leave(None)
             return
@@ -369,67 +939,39 @@ class Espionage(Cog, name=COG_ESPIONAGE):
         if not cmd:
             return
 
-        filters = []
-        extra_opts = []
-        if isinstance(cmd, dict):
-            midi = "midi" in cmd and cmd["midi"]
-            rate = None
-            speed: int
-            speed = cmd["speed"] if "speed" in cmd else 100
-            if speed != 100:
-                if "info" in cmd:
-                    rate = cmd["info"]["sample_rate"]
-                    rate = rate * speed / 100
-                    rate = int(rate)
-                else:  # for MIDI and music packs
-                    rate = 44100 * speed / 100
-                    rate = int(rate)
-                if start:
-                    # adjust starting position for the current playback speed
-                    start = start / (speed / 100.0)
-
-            if rate:
-                filters.append(f"asetrate={rate}")
-            if midi:
-                filters.append("aformat=channel_layouts=2")
-
-            for line in cmd.get("filters", []):
-                _, _, value = line.partition("#")
-                if value.startswith("-"):
-                    extra_opts.append(value)
-                else:
-                    filters.append(value)
-        else:
-            midi = False
-            speed = 100
+        info = await offload(self.file_info, cmd, filename)
+        filters, extra_opts, speed, start = self.get_filters(cmd, start, info)
 
-        if LOG_CSV:
-            with open(LOG_CSV, "a+", encoding="utf-8") as f:
-                fields = [
-                    str(int(time())),
-                    str(guild_id),
-                    channel.guild.name,
-                    str(member.id),
-                    f"{member.name}#{member.discriminator}",
-                    cmd_orig or "None",
-                    relpath(filename, UPLOAD_PATH),
-                    f"{speed}%",
-                ]
-                f.write(";".join(fields) + "\n")
+        self.log_play(channel.guild, member, cmd_orig, cmd_name, filename, info, speed)
 
-        extra_info = ""
-        if midi:
-            sf2s = cmd["sf2s"]
-            sf2 = random_choice(sf2s) if sf2s else None
-            sf2s = list(self.sf2s.values())
-            if not sf2s or MIDI_IMPL == MIDI_IMPL_NONE:
-                return
-            sf2 = self.sf2s[sf2] if sf2 in self.sf2s else random_choice(sf2s)
-            sf2_name = real_filename(sf2)
-            extra_info = f"with SF2 '{sf2_name}' "
-            source = FFmpegMidiOpusAudio(filename, sf2_name, filters, extra_opts, start)
+        # discard the prepared track if it's not used
+        unused = self.prefetched.pop(guild_id, None)
+        if unused and unused is not prefetch:
+            unused.source.cleanup()
+
+        if prefetch:
+            source = prefetch.source
+            extra_info = "prefetched "
         else:
-            source = FFmpegFileOpusAudio(filename, filters, extra_opts, start)
+            # spawns ffmpeg or loads the packet store
+            source, extra_info = await offload(
+                self.create_source,
+                cmd,
+                filename,
+                filters,
+                extra_opts,
+                start,
+                pack,
+                gapless,
+            )
+        if not source:
+            return
+        # the bot might have been disconnected in the meantime
+        if not voice.is_connected() or voice.is_playing():
+            source.cleanup()
+            return
+        # count the played frames for reloading and !np
+        source = ClockedAudio(source, start)
 
         # print log info
         print(
@@ -449,9 +991,9 @@ class Espionage(Cog, name=COG_ESPIONAGE):
             cmd_name=cmd_name,
             cmd_orig=cmd_orig,
             filename=filename,
-            # calculate starting timestamp according to current playback speed
-            timestamp=time() - start,
+            clock=source,
             speed=speed,
+            dsp=find_source(source, DSPAudio),
         )
 
         if cmd_name:
@@ -461,4 +1003,14 @@ class Espionage(Cog, name=COG_ESPIONAGE):
         else:
             new_nick = None
         self.bot.loop.create_task(self.update_nickname(channel.guild, new_nick))
-        voice.play(source, after=loop and repeat or leave)
+        # prepare the next track of a pack or !random
+        if loop and not gapless:
+            duration = played_duration(info)
+            delay = max(duration * 100.0 / speed - start - PREFETCH_TIME, 0.0)
+            self.bot.loop.call_soon_threadsafe(
+                self.schedule_prefetch, guild_id, cmd_orig, delay
+            )
+        else:
+            self.bot.loop.call_soon_threadsafe(self.schedule_prefetch, guild_id)
+        # repeat() leaves the channel if looping is disabled in the meantime
+        voice.play(source, after=repeat)
@@ -0,0 +1,224 @@
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from settings import (
+    LOUDNESS_MAX_GAIN,
+    LOUDNESS_TARGET,
+    NORMALIZE_LOUDNESS,
+    TRUE_PEAK_LIMIT,
+)
+
+FILTER_VOLUME = "volume"
+FILTER_BASS = "bass"
+FILTER_TREBLE = "treble"
+FILTER_PITCH = "pitch"
+FILTER_OPTION = "option"
+FILTER_RAW = "raw"
+# consecutive filters of these kinds are merged into one
+FILTER_MERGEABLE = [FILTER_VOLUME, FILTER_BASS, FILTER_TREBLE, FILTER_PITCH]
+# filters of these kinds may be applied live, without ffmpeg
+FILTER_DSP = [FILTER_VOLUME, FILTER_BASS, FILTER_TREBLE]
+
+VOLUME_RE = re.compile(r"^volume=([\d.]+)$")
+GAIN_RE = re.compile(r"^(bass|treble)=g=(-?[\d.]+)$")
+PITCH_RE = re.compile(r"^asetrate=44100\*([\d.]+),aresample=44100,atempo=1/[\d.]+$")
+FREQ_RE = re.compile(r"(\d+) Hz")
+TRIM_RE = re.compile(r"^atrim=start=([\d.]+)(?::end=([\d.]+))?$")
+
+
+@dataclass
+class Filter:
+    kind: str
+    # "title#value", as stored in the command descriptor
+    line: str
+    value: str
+    # volume or pitch factor, gain in dB
+    amount: float = 0.0
+
+    def is_noop(self) -> bool:
+        if self.kind in [FILTER_VOLUME, FILTER_PITCH]:
+            return abs(self.amount - 1.0) < 0.0001
+        if self.kind in [FILTER_BASS, FILTER_TREBLE]:
+            return abs(self.amount) < 0.005
+        return self.value == "anull"
+
+
+def format_number(value: float) -> str:
+    return f"{value:.04f}".rstrip("0").rstrip(".")
+
+
+def parse_filter(line: str) -> Filter:
+    _, _, value = line.partition("#")
+    match = VOLUME_RE.match(value)
+    if match:
+        return Filter(FILTER_VOLUME, line, value, float(match.group(1)))
+    match = GAIN_RE.match(value)
+    if match:
+        return Filter(match.group(1), line, value, float(match.group(2)))
+    match = PITCH_RE.match(value)
+    if match:
+        return Filter(FILTER_PITCH, line, value, float(match.group(1)))
+    if value.startswith("-"):
+        return Filter(FILTER_OPTION, line, value)
+    return Filter(FILTER_RAW, line, value)
+
+
+def merge_filters(first: Filter, second: Filter) -> Filter:
+    kind = first.kind
+    if kind == FILTER_VOLUME:
+        amount = first.amount * second.amount
+        title = f"{round(amount * 100)}% Volume"
+        value = f"volume={format_number(amount)}"
+    elif kind == FILTER_PITCH:
+        amount = first.amount * second.amount
+        title = f"{round(amount * 100)}% Pitch"
+        value = (
+            f"asetrate=44100*{format_number(amount)},"
+            f"aresample=44100,"
+            f"atempo=1/{format_number(amount)}"
+        )
+    else:
+        amount = first.amount + second.amount
+        match = FREQ_RE.search(first.line.partition("#")[0])
+        freq = f" {match.group(1)} Hz" if match else ""
+        title = f"{round(10 ** (amount / 10) * 100)}% {kind.capitalize()}{freq}"
+        value = f"{kind}=g={amount:.02f}"
+    return Filter(kind, f"{title}#{value}", value, amount)
+
+
+def normalize_filters(lines: List[str]) -> List[str]:
+    result: List[Filter] = []
+    for item in map(parse_filter, lines):
+        if item.is_noop():
+            continue
+        prev = result[-1] if result else None
+        if prev and prev.kind == item.kind and item.kind in FILTER_MERGEABLE:
+            item = merge_filters(result.pop(), item)
+            if item.is_noop():
+                continue
+        elif item.value.startswith("-b:a "):
+            # only the last bitrate applies
+            result = [r for r in result if not r.value.startswith("-b:a ")]
+        result.append(item)
+    return [item.line for item in result]
+
+
+def ffmpeg_filters(lines: List[str]) -> List[str]:
+    # the filters which can't be changed without restarting ffmpeg
+    items = map(parse_filter, normalize_filters(lines))
+    return [item.line for item in items if item.kind not in FILTER_DSP]
+
+
+def tempo_filters(tempo: float) -> List[str]:
+    # atempo accepts factors between 0.5 and 2.0 in older ffmpeg versions
+    filters = []
+    while tempo < 0.5:
+        filters.append("atempo=0.5")
+        tempo /= 0.5
+    while tempo > 2.0:
+        filters.append("atempo=2.0")
+        tempo /= 2.0
+    filters.append(f"atempo={format_number(tempo)}")
+    return filters
+
+
+@lru_cache(maxsize=1024)
+def compile_filters(
+    lines: Tuple[str, ...],
+    speed: int,
+    sample_rate: int,
+    midi: bool,
+    dsp: bool = False,
+) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    # returns (filters, extra_opts) for ffmpeg,
+    # without the filters applied by the DSP stage if dsp is True
+    items = [parse_filter(line) for line in normalize_filters(list(lines))]
+    if dsp:
+        items = [item for item in items if item.kind not in FILTER_DSP]
+    filters = []
+    extra_opts = []
+
+    # pitch changes at the start are applied together with the speed,
+    # volume changes don't depend on the sample rate and may be moved
+    pitch = 1.0
+    volumes = []
+    while items and items[0].kind in [FILTER_PITCH, FILTER_VOLUME]:
+        item = items.pop(0)
+        if item.kind == FILTER_PITCH:
+            pitch *= item.amount
+        else:
+            volumes.append(item)
+    items = volumes + items
+    rate = int(sample_rate * speed / 100 * pitch)
+    if rate != sample_rate:
+        filters.append(f"asetrate={rate}")
+    if midi:
+        filters.append("aformat=channel_layouts=2")
+    if pitch != 1.0:
+        filters += tempo_filters(1.0 / pitch)
+
+    for item in items:
+        if item.kind == FILTER_PITCH:
+            # keep the current sample rate for the following filters
+            filters.append(f"asetrate={int(rate * item.amount)}")
+            filters.append(f"aresample={rate}")
+            filters += tempo_filters(1.0 / item.amount)
+        elif item.kind == FILTER_OPTION:
+            extra_opts.append(item.value)
+        else:
+            filters.append(item.value)
+    return tuple(filters), tuple(extra_opts)
+
+
+def loudness_filters(info: dict) -> List[str]:
+    # static trim and gain from the upload-time analysis
+    filters = []
+    if "loudness" not in info:
+        return filters
+    trim_start = info.get("trim_start", None) or 0.0
+    trim_end = info.get("trim_end", None)
+    if trim_start > 0.05 or trim_end:
+        trim = f"atrim=start={trim_start:.03f}"
+        if trim_end:
+            trim += f":end={trim_end:.03f}"
+        filters += [trim, "asetpts=PTS-STARTPTS"]
+    gain = LOUDNESS_TARGET - info["loudness"]
+    gain = min(gain, TRUE_PEAK_LIMIT - info["true_peak"], LOUDNESS_MAX_GAIN)
+    # small differences are not worth rendering a variant
+    if abs(gain) >= 1.0:
+        filters.append(f"volume={gain:.01f}dB")
+    return filters
+
+
+def played_duration(info: Optional[dict]) -> float:
+    # length of the file as played, positions in the file are counted
+    # from the start of the trimmed audio
+    duration = (info or {}).get("duration", None) or 0.0
+    filters = loudness_filters(info) if NORMALIZE_LOUDNESS and info else []
+    match = TRIM_RE.match(filters[0]) if filters else None
+    if not match:
+        return duration
+    trim_start = float(match.group(1))
+    trim_end = match.group(2) and float(match.group(2))
+    return max((trim_end or duration) - trim_start, 0.0)
+
+
+def seek_filters(filters: List[str], position: float) -> Tuple[List[str], float]:
+    # returns the filters for playing from 'position' seconds of the trimmed
+    # file at normal speed, and the input offset to seek to;
+    # timestamps start from zero after seeking the input
+    trim_start = 0.0
+    trim_end = None
+    match = TRIM_RE.match(filters[0]) if filters else None
+    if match:
+        trim_start = float(match.group(1))
+        trim_end = match.group(2) and float(match.group(2))
+        # drop atrim and asetpts
+        filters = filters[2:]
+    seek = trim_start + position
+    if trim_end:
+        trim = f"atrim=end={max(trim_end - seek, 0.0):.03f}"
+        filters = [trim, "asetpts=PTS-STARTPTS"] + filters
+    return filters, seek
@@ -0,0 +1,141 @@
+import asyncio
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from os import mkdir, unlink
+from os.path import basename, join
+from pathlib import Path
+from shutil import copyfileobj
+from tempfile import TemporaryDirectory
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+import aiohttp
+from discord import Attachment, Message
+from discord.ext.commands import Context
+
+from blobs import HashingWriter
+from settings import DOWNLOAD_CHUNK_SIZE, INGEST_WORKERS
+from utils import SNIFF_SIZE, check_buffer
+
+ingest_pool = ThreadPoolExecutor(
+    max_workers=INGEST_WORKERS, thread_name_prefix="ingest"
+)
+
+
+@dataclass
+class IngestJob:
+    ctx: Context
+    name: str
+    cmd: Optional[dict]
+    attachments: List[Attachment]
+    progress: Message
+    pack: bool
+    existing: bool
+    single: bool
+    dirname: str = ""
+    midi: bool = False
+    video: bool = False
+    saved_count: int = 0
+    saved_name: str = ""
+    invalid_count: int = 0
+    invalid_name: str = ""
+
+    def saved(self, name: str):
+        self.saved_count += 1
+        self.saved_name = name
+
+    def invalid(self, name: str):
+        self.invalid_count += 1
+        self.invalid_name = name
+
+    async def update(self, text: str):
+        await self.progress.edit(content=f":hourglass: {text}")
+
+    async def fail(self, text: str):
+        await self.progress.edit(content=text, delete_after=3)
+
+
+async def download(attachment: Attachment, filename: str) -> Tuple[bytes, str]:
+    # streams the attachment to the file,
+    # returns its header and the SHA-256 of the data
+    loop = asyncio.get_running_loop()
+    header = b""
+    buffer = bytearray()
+    f = await loop.run_in_executor(ingest_pool, open, filename, "wb")
+    try:
+        writer = HashingWriter(f)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(attachment.url) as response:
+                response.raise_for_status()
+                async for data in response.content.iter_any():
+                    buffer += data
+                    if len(buffer) < DOWNLOAD_CHUNK_SIZE:
+                        continue
+                    header = header or bytes(buffer[0:SNIFF_SIZE])
+                    await loop.run_in_executor(ingest_pool, writer.write, buffer)
+                    buffer.clear()
+        header = header or bytes(buffer[0:SNIFF_SIZE])
+        await loop.run_in_executor(ingest_pool, writer.write, buffer)
+        await loop.run_in_executor(ingest_pool, f.close)
+    except BaseException:
+        # don't leave a partial file behind, also when cancelled
+        f.close()
+        unlink(filename)
+        raise
+    return header, writer.hexdigest()
+
+
+def archive_members(filename: str) -> Iterator[Tuple[str, BinaryIO]]:
+    if zipfile.is_zipfile(filename):
+        with zipfile.ZipFile(filename) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                with archive.open(info) as f:
+                    yield info.filename, f
+        return
+
+    try:
+        # read the members sequentially, without seeking
+        archive = tarfile.open(filename, mode="r|*")
+    except tarfile.TarError:
+        archive = None
+    if archive:
+        with archive:
+            for member in archive:
+                if member.isfile():
+                    yield member.name, archive.extractfile(member)
+        return
+
+    # other formats need external tools
+    import patoolib
+
+    with TemporaryDirectory() as tmp:
+        outdir = join(tmp, "out")
+        mkdir(outdir)
+        patoolib.extract_archive(filename, outdir=outdir, verbosity=-1)
+        for member in Path(outdir).rglob("*"):
+            if not member.is_file():
+                continue
+            with open(member, "rb") as f:
+                yield str(member), f
+
+
+def extract_archive(job: IngestJob, filename: str):
+    # copy audio files from the archive straight to the pack
+    for path, f in archive_members(filename):
+        name = basename(path.replace("\\", "/"))
+        if not name:
+            continue
+        header = f.read(SNIFF_SIZE)
+        (audvid, _, _, midi, video) = check_buffer(header)
+        if not audvid:
+            job.invalid(name)
+            continue
+        job.midi = job.midi or midi
+        job.video = job.video or video
+        with open(join(job.dirname, name), "wb") as out:
+            out.write(header)
+            copyfileobj(f, out)
+        job.saved(name)
@@ -1,37 +1,311 @@
-from typing import Dict
+from math import ceil
+from time import time
+from typing import Dict, List, Optional, Tuple
 
 from discord.ext import commands
 from discord.ext.commands import Bot, Cog, Context
 
 from espionage import Espionage
-from settings import COG_ESPIONAGE, COG_MUSIC, RANDOM_FILE
+from filterchain import played_duration
+from search import command_search
+from settings import (
+    COG_ESPIONAGE,
+    COG_MUSIC,
+    LIBRARY_FILTER_GUILD,
+    LIBRARY_PAGE_SIZE,
+    LIBRARY_SORT_NAME,
+    LIBRARY_SORT_NEWEST,
+    LIBRARY_SORT_PLAYS,
+    LIBRARY_SORTS,
+    RANDOM_FILE,
+    RANDOM_MODE_UNIFORM,
+    RANDOM_MODES,
+    SEEK_STEP,
+    STATS_PERIOD_WEEK,
+    STATS_PERIODS,
+    STATS_TOP_COUNT,
+)
+from stats import STATS_ALL, STATS_COMMAND, STATS_GUILD, STATS_USER
+from storage import Storage
 from utils import (
+    ReplayInfo,
     check_playing_cmd,
+    ensure_can_modify,
     ensure_command,
     ensure_voice,
     normalize_percent,
-    save_files,
+    offload,
+    original_filename,
+    upload_time,
 )
 
 
+def format_airtime(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes} min"
+    return f"{minutes // 60} h {minutes % 60:02d} min"
+
+
+def format_position(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+
+def parse_position(text: str) -> Optional[float]:
+    # "90", "1:30" or "1:01:30"
+    seconds = 0.0
+    for part in text.split(":"):
+        try:
+            seconds = seconds * 60 + float(part)
+        except ValueError:
+            return None
+    return seconds if seconds >= 0 else None
+
+
 class Music(Cog, name=COG_MUSIC):
-    def __init__(self, bot: Bot, files: Dict[str, dict], sf2s: Dict[str, str]):
+    # {(sort, guild_id): (files version, build time, lines)}
+    listings: Dict[Tuple[str, Optional[int]], Tuple[int, float, List[str]]]
+
+    def __init__(self, bot: Bot, files: Storage, sf2s: Storage):
         self.bot = bot
         self.files = files
         self.sf2s = sf2s
         self.espionage: Espionage = self.bot.get_cog(COG_ESPIONAGE)
+        self.listings = {}
+
+    def format_line(self, name: str) -> str:
+        description = self.espionage.describe(name)
+        if len(description) > 80:
+            description = description[0:77] + "..."
+        return f"- `!{name}` - {description}"
+
+    def get_listing(self, sort: str, guild_id: Optional[int]) -> List[str]:
+        version, built, lines = self.listings.get((sort, guild_id), (-1, 0.0, []))
+        # play counts change with every play, rebuild periodically
+        outdated = sort == LIBRARY_SORT_PLAYS and time() - built > 300
+        if version == self.files.version and not outdated:
+            return lines
+
+        if guild_id:
+            names = [
+                name for name in self.files.by_guild(guild_id) if name in self.files
+            ]
+        else:
+            names = list(self.files.keys())
+        if sort == LIBRARY_SORT_NEWEST:
+            names.sort(key=lambda name: upload_time(self.files[name]), reverse=True)
+        elif sort == LIBRARY_SORT_PLAYS:
+            stats = self.espionage.stats
+            names.sort(key=lambda name: (-stats.plays(STATS_COMMAND, name), name))
+        else:
+            names.sort()
+
+        lines = [self.format_line(name) for name in names]
+        self.listings[(sort, guild_id)] = (self.files.version, time(), lines)
+        return lines
+
+    @commands.command(aliases=["ls"])
+    async def library(self, ctx: Context, *args: str):
+        """List audio commands ([name/newest/plays] [page] [guild])."""
+        sort = LIBRARY_SORT_NAME
+        page = 1
+        guild_id = None
+        for arg in args:
+            if arg.isdigit():
+                page = int(arg)
+            elif arg in LIBRARY_SORTS:
+                sort = arg
+            elif arg == LIBRARY_FILTER_GUILD and ctx.guild:
+                guild_id = ctx.guild.id
+            else:
+                await ctx.send(
+                    f":question: Usage: `!library [{'/'.join(LIBRARY_SORTS)}] "
+                    f"[page] [{LIBRARY_FILTER_GUILD}]`.",
+                    delete_after=3,
+                )
+                return
+
+        lines = self.get_listing(sort, guild_id)
+        pages = max(ceil(len(lines) / LIBRARY_PAGE_SIZE), 1)
+        if page not in range(1, pages + 1):
+            await ctx.send(f":x: Page must be in [1,{pages}] range.", delete_after=3)
+            return
+
+        start = (page - 1) * LIBRARY_PAGE_SIZE
+        text = [
+            f":v: Audio commands ({len(lines)}), page {page}/{pages}:",
+            *lines[start : start + LIBRARY_PAGE_SIZE],
+        ]
+        if page < pages:
+            filter_arg = f" {LIBRARY_FILTER_GUILD}" if guild_id else ""
+            text.append(
+                f":question: Use `!library {sort} {page + 1}{filter_arg}` "
+                "to see the next page."
+            )
+        await ctx.send("\n".join(text))
 
     @commands.command()
     @commands.guild_only()
     @commands.before_invoke(ensure_voice)
-    async def random(self, ctx: Context):
-        """Randomly play files from the global directory."""
+    async def random(self, ctx: Context, mode: str = None):
+        """Randomly play files (uniform/duration/plays/weight)."""
+        mode = mode or RANDOM_MODE_UNIFORM
+        if mode not in RANDOM_MODES:
+            await ctx.send(
+                f":question: Usage: `!random [{'/'.join(RANDOM_MODES)}]`.",
+                delete_after=3,
+            )
+            return
+        self.espionage.random_mode[ctx.guild.id] = mode
         await self.espionage.play(
             channel=ctx.voice_client.channel,
             member=ctx.message.author,
             cmd=RANDOM_FILE,
         )
 
+    async def get_playing(self, ctx: Context) -> Optional[ReplayInfo]:
+        replay_info = self.espionage.replay_info.get(ctx.guild.id, None)
+        if not replay_info or not replay_info.cmd_name:
+            await ctx.send(":x: Nothing is playing.", delete_after=3)
+            return None
+        return replay_info
+
+    async def seek_to(self, ctx: Context, replay_info: ReplayInfo, position: float):
+        name = replay_info.cmd_name
+        info = await offload(
+            self.espionage.file_info, replay_info.cmd, replay_info.filename
+        )
+        duration = played_duration(info)
+        if duration and position >= duration:
+            await ctx.send(
+                f":x: `!{name}` is only {format_position(duration)} long.",
+                delete_after=3,
+            )
+            return
+        self.espionage.seek(ctx.guild, position)
+        await ctx.send(f":v: Playing `!{name}` from {format_position(position)}.")
+
+    async def skip(self, ctx: Context, seconds: Optional[str], direction: int):
+        replay_info = await self.get_playing(ctx)
+        if not replay_info:
+            return
+        step = parse_position(seconds) if seconds else SEEK_STEP
+        if step is None:
+            await ctx.send(f":x: `{seconds}` is not a valid time.", delete_after=3)
+            return
+        info = await offload(
+            self.espionage.file_info, replay_info.cmd, replay_info.filename
+        )
+        duration = played_duration(info)
+        position = replay_info.position()
+        if duration:
+            # looping sources count the previous iterations too
+            position %= duration
+        await self.seek_to(ctx, replay_info, max(position + step * direction, 0.0))
+
+    @commands.command()
+    @commands.guild_only()
+    async def seek(self, ctx: Context, position: str = None):
+        """Play the current audio from the specified time ([h:]m:s)."""
+        position = position and parse_position(position)
+        if position is None:
+            await ctx.send(":question: Usage: `!seek <[h:]m:s>`.", delete_after=3)
+            return
+        replay_info = await self.get_playing(ctx)
+        if not replay_info:
+            return
+        await self.seek_to(ctx, replay_info, position)
+
+    @commands.command()
+    @commands.guild_only()
+    async def ff(self, ctx: Context, seconds: str = None):
+        """Skip forward in the current audio (10 seconds by default)."""
+        await self.skip(ctx, seconds, 1)
+
+    @commands.command()
+    @commands.guild_only()
+    async def rw(self, ctx: Context, seconds: str = None):
+        """Skip back in the current audio (10 seconds by default)."""
+        await self.skip(ctx, seconds, -1)
+
+    @commands.command()
+    @commands.guild_only()
+    async def np(self, ctx: Context):
+        """Show the currently playing command and its position."""
+        replay_info = await self.get_playing(ctx)
+        if not replay_info:
+            return
+
+        name = replay_info.cmd_name
+        position = replay_info.position()
+        info = await offload(
+            self.espionage.file_info, replay_info.cmd, replay_info.filename
+        )
+        duration = played_duration(info)
+        text = f":arrow_forward: Now playing `!{name}`"
+        if replay_info.cmd.get("pack", False):
+            text += f" - {original_filename(replay_info.filename)}"
+        if duration:
+            # looping sources count the previous iterations too
+            position %= duration
+            text += f" - {format_position(position)} / {format_position(duration)}"
+        else:
+            text += f" - {format_position(position)}"
+        if replay_info.speed != 100:
+            text += f" at {replay_info.speed}%"
+        await ctx.send(text)
+
+    @commands.command()
+    async def find(self, ctx: Context, *query: str):
+        """Search audio commands by name, description or file name."""
+        query = " ".join(query)
+        if not query:
+            await ctx.send(":question: Usage: `!find <query>`.", delete_after=3)
+            return
+
+        names = [name for name in command_search.find(query) if name in self.files]
+        if not names:
+            await ctx.send(f":x: Nothing found for `{query}`.", delete_after=3)
+            return
+        lines = [f":v: Found {len(names)} command(s):"]
+        for name in names:
+            lines.append(self.format_line(name))
+        await ctx.send("\n".join(lines))
+
+    @commands.command()
+    async def stats(self, ctx: Context, period: str = STATS_PERIOD_WEEK):
+        """Show the most played commands, users and guilds (day/week/all)."""
+        if period not in STATS_PERIODS:
+            await ctx.send(
+                f":question: Usage: `!stats [{'/'.join(STATS_PERIODS)}]`.",
+                delete_after=3,
+            )
+            return
+
+        hours = STATS_PERIODS[period]
+        stats = self.espionage.stats
+        total = stats.top(STATS_ALL, hours, 1)
+        if not total:
+            await ctx.send(":x: Nothing was played yet.", delete_after=3)
+            return
+        _, plays, airtime = total[0]
+        lines = [f":bar_chart: **{plays}** plays, {format_airtime(airtime)} of airtime"]
+        sections = [
+            ("Top commands", STATS_COMMAND, "`!{}`"),
+            ("Top users", STATS_USER, "**{}**"),
+            ("Busiest guilds", STATS_GUILD, "**{}**"),
+        ]
+        for title, kind, fmt in sections:
+            items = stats.top(kind, hours, STATS_TOP_COUNT)
+            lines.append(f"{title}:")
+            for i, (name, plays, airtime) in enumerate(items):
+                lines.append(
+                    f"{i + 1}. {fmt.format(name)} - {plays} plays, "
+                    f"{format_airtime(airtime)}"
+                )
+        await ctx.send("\n".join(lines))
+
     @commands.command()
     async def loop(self, ctx: Context, name: str = None):
         """Enable/disable looping of the specified audio."""
@@ -53,8 +327,10 @@ class Music(Cog, name=COG_MUSIC):
         # remove the command to update help text
         self.espionage.remove_command(name)
         self.espionage.add_command(name)
-        # save the command descriptors
-        save_files(self.files)
+        # save the command descriptor
+        self.files.save(name)
+        # apply to the currently playing guilds
+        self.espionage.update_loop(name)
 
         if cmd["loop"]:
             await ctx.send(f":v: :white_check_mark: Looping enabled for `!{name}`.")
@@ -90,14 +366,47 @@ class Music(Cog, name=COG_MUSIC):
         else:
             cmd.pop("speed", None)
 
-        # save the command descriptors
-        save_files(self.files)
+        # save the command descriptor
+        self.files.save(name)
 
         await ctx.send(f":v: Speed of `!{name}` set to {speed}%.")
 
         if ctx.guild and ctx.guild.voice_client:
             self.espionage.reload(guild=ctx.guild)
 
+    @commands.command()
+    async def weight(self, ctx: Context, name: str = None, weight: str = None):
+        """Set the weight for weighted !random (default 1)."""
+        if not name or not weight:
+            await ctx.send(
+                ":question: Usage: `!weight <command name> <weight>`.",
+                delete_after=3,
+            )
+            return
+
+        try:
+            weight = float(weight)
+        except ValueError:
+            await ctx.send(f":x: `{weight}` is not a valid number.", delete_after=3)
+            return
+        if weight <= 0 or weight > 1000:
+            await ctx.send(f":x: Weight must be in (0,1000] range.", delete_after=3)
+            return
+
+        cmd = await ensure_command(ctx, name, self.files)
+        await ensure_can_modify(ctx, cmd)
+
+        if weight != 1.0:
+            cmd["weight"] = weight
+        else:
+            cmd.pop("weight", None)
+
+        # save the command descriptor
+        self.files.save(name)
+        self.espionage.update_weights(name)
+
+        await ctx.send(f":v: Weight of `!{name}` set to {weight:g}.")
+
     @commands.command()
     async def sf(self, ctx: Context, name: str = None, sf2: str = None):
         """List or set SoundFonts for MIDI files."""
@@ -130,7 +439,7 @@ class Music(Cog, name=COG_MUSIC):
             return
 
         cmd["sf2s"] = [sf2]
-        save_files(self.files)
+        self.files.save(name)
 
         await ctx.send(f":v: Updated SoundFonts for `!{name}`.")
 
@@ -0,0 +1,249 @@
+import asyncio
+import atexit
+import gzip
+import re
+import struct
+import sys
+from dataclasses import dataclass
+from glob import escape, glob
+from os import stat, unlink
+from os.path import isfile, samefile
+from shutil import copyfileobj
+from threading import Lock
+from time import localtime, strftime, time
+from typing import BinaryIO, Iterator, List, Optional
+
+from settings import (
+    LOG_CSV,
+    PLAY_LOG,
+    PLAY_LOG_FLUSH_TIME,
+    PLAY_LOG_MAX_SIZE,
+)
+from utils import offload
+
+PLAY_LOG_MAGIC = b"PLOG\x01"
+# timestamp, guild ID, member ID, speed
+PLAY_RECORD = struct.Struct("<IQQH")
+PLAY_STRING = struct.Struct("<H")
+# guild name;member ID;member name;command;filename - between the fixed
+# fields of a CSV line, guild names and filenames may contain the separator
+CSV_MIDDLE = re.compile(r"^(.*?);(\d+);([^;]*#\d+);([^;]*);(.*)$")
+
+
+@dataclass
+class PlayRecord:
+    timestamp: int
+    guild_id: int
+    guild_name: str
+    member_id: int
+    member_name: str
+    cmd: str
+    filename: str
+    speed: int
+
+    def encode(self) -> bytes:
+        data = [
+            PLAY_RECORD.pack(self.timestamp, self.guild_id, self.member_id, self.speed)
+        ]
+        for text in [self.guild_name, self.member_name, self.cmd, self.filename]:
+            text = text.encode("utf-8")[0:0xFFFF]
+            data.append(PLAY_STRING.pack(len(text)))
+            data.append(text)
+        return b"".join(data)
+
+    @staticmethod
+    def decode(f: BinaryIO) -> Optional["PlayRecord"]:
+        header = f.read(PLAY_RECORD.size)
+        if len(header) < PLAY_RECORD.size:
+            return None
+        timestamp, guild_id, member_id, speed = PLAY_RECORD.unpack(header)
+        texts = []
+        for _ in range(4):
+            length = f.read(PLAY_STRING.size)
+            if len(length) < PLAY_STRING.size:
+                return None
+            (length,) = PLAY_STRING.unpack(length)
+            text = f.read(length)
+            if len(text) < length:
+                return None
+            texts.append(text.decode("utf-8", errors="replace"))
+        guild_name, member_name, cmd, filename = texts
+        return PlayRecord(
+            timestamp=timestamp,
+            guild_id=guild_id,
+            guild_name=guild_name,
+            member_id=member_id,
+            member_name=member_name,
+            cmd=cmd,
+            filename=filename,
+            speed=speed,
+        )
+
+    def csv_line(self) -> str:
+        fields = [
+            str(self.timestamp),
+            str(self.guild_id),
+            self.guild_name,
+            str(self.member_id),
+            self.member_name,
+            self.cmd,
+            self.filename,
+            f"{self.speed}%",
+        ]
+        return ";".join(fields)
+
+
+class PlayLog:
+    """Play records buffered in memory and appended to PLAY_LOG periodically.
+
+    The log is rotated when it exceeds PLAY_LOG_MAX_SIZE or on a new day;
+    rotated files are compressed with gzip and kept next to the log.
+    """
+
+    def __init__(self, filename: str = PLAY_LOG):
+        self.filename = filename
+        self.records: List[bytes] = []
+        # records are added from the player thread too
+        self.lock = Lock()
+        # flushing runs in worker threads
+        self.flush_lock = Lock()
+        self.day = strftime("%Y%m%d", localtime(self.mtime()))
+        # don't lose the buffered records on shutdown
+        atexit.register(self.flush)
+
+    def mtime(self) -> float:
+        try:
+            return stat(self.filename).st_mtime
+        except OSError:
+            return time()
+
+    def add(self, record: PlayRecord):
+        data = record.encode()
+        with self.lock:
+            self.records.append(data)
+
+    def flush(self):
+        with self.lock:
+            records, self.records = self.records, []
+        with self.flush_lock:
+            day = strftime("%Y%m%d")
+            if day != self.day:
+                self.rotate()
+                self.day = day
+            if not records:
+                return
+            new = not isfile(self.filename)
+            with open(self.filename, "ab") as f:
+                if new:
+                    f.write(PLAY_LOG_MAGIC)
+                f.write(b"".join(records))
+            if stat(self.filename).st_size >= PLAY_LOG_MAX_SIZE:
+                self.rotate()
+
+    def rotate(self):
+        if not isfile(self.filename):
+            return
+        date = strftime("%Y%m%d-%H%M%S")
+        index = 0
+        while isfile(f"{self.filename}.{date}.{index:03d}.gz"):
+            index += 1
+        name = f"{self.filename}.{date}.{index:03d}.gz"
+        with open(self.filename, "rb") as src, gzip.open(name, "wb") as dst:
+            copyfileobj(src, dst)
+        unlink(self.filename)
+        print(f"Rotated the play log to '{name}'")
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(PLAY_LOG_FLUSH_TIME)
+            await offload(self.flush)
+
+
+def log_files(filename: str = PLAY_LOG) -> List[str]:
+    # rotated files are named by date, so they sort chronologically
+    files = sorted(glob(f"{escape(filename)}.*.gz"))
+    if isfile(filename):
+        files.append(filename)
+    return files
+
+
+def read_records(filename: str) -> Iterator[PlayRecord]:
+    opener = gzip.open if filename.endswith(".gz") else open
+    with opener(filename, "rb") as f:
+        if f.read(len(PLAY_LOG_MAGIC)) != PLAY_LOG_MAGIC:
+            return
+        while True:
+            try:
+                record = PlayRecord.decode(f)
+            except (EOFError, OSError):
+                # an unfinished gzip stream
+                return
+            if not record:
+                return
+            yield record
+
+
+def read_all(filename: str = PLAY_LOG) -> Iterator[PlayRecord]:
+    for name in log_files(filename):
+        yield from read_records(name)
+
+
+def parse_csv_line(line: str) -> Optional[PlayRecord]:
+    # timestamp;guild ID;guild name;member ID;member name;command;filename;speed%
+    fields = line.split(";", 2)
+    if len(fields) < 3:
+        return None
+    timestamp, guild_id, rest = fields
+    fields = rest.rsplit(";", 1)
+    if len(fields) < 2:
+        return None
+    middle, speed = fields
+    match = CSV_MIDDLE.match(middle)
+    if not match or not timestamp.isdigit() or not guild_id.isdigit():
+        return None
+    if not speed.endswith("%"):
+        return None
+    guild_name, member_id, member_name, cmd, filename = match.groups()
+    try:
+        speed = int(float(speed[0:-1] or 100))
+    except ValueError:
+        return None
+    return PlayRecord(
+        timestamp=int(timestamp),
+        guild_id=int(guild_id),
+        guild_name=guild_name,
+        member_id=int(member_id),
+        member_name=member_name,
+        cmd=cmd,
+        filename=filename,
+        speed=speed,
+    )
+
+
+def read_csv_records() -> Iterator[PlayRecord]:
+    # plays from the legacy LOG_CSV
+    if not LOG_CSV or not isfile(LOG_CSV):
+        return
+    with open(LOG_CSV, "r", encoding="utf-8", errors="replace") as f:
+        for line in f:
+            record = parse_csv_line(line.rstrip("\n"))
+            if record:
+                yield record
+
+
+def export_csv(output: str):
+    if LOG_CSV and isfile(output) and samefile(output, LOG_CSV):
+        raise SystemExit("Refusing to overwrite LOG_CSV")
+    with open(output, "w", encoding="utf-8") as f:
+        # older plays were logged directly as CSV
+        if LOG_CSV and isfile(LOG_CSV):
+            with open(LOG_CSV, "r", encoding="utf-8", errors="replace") as src:
+                copyfileobj(src, f)
+        for record in read_all():
+            f.write(record.csv_line() + "\n")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        raise SystemExit("Usage: python playlog.py <output.csv>")
+    export_csv(sys.argv[1])
@@ -0,0 +1,332 @@
+import asyncio
+import json
+import re
+import struct
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from os import stat
+from typing import BinaryIO, Dict, Iterable, List, Optional, Tuple
+
+from settings import PROBE_WORKERS, SILENCE_MIN_DURATION, SILENCE_THRESHOLD
+
+# {(filename, size, mtime): info}
+probe_cache: Dict[Tuple[str, int, float], Optional[dict]] = {}
+probe_pool = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix="probe")
+
+MP3_BITRATES_V1 = [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+MP3_BITRATES_V2 = [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160]
+MP3_SAMPLE_RATES = {
+    3: [44100, 48000, 32000],  # MPEG 1
+    2: [22050, 24000, 16000],  # MPEG 2
+    0: [11025, 12000, 8000],  # MPEG 2.5
+}
+
+
+def make_info(sample_rate: int, duration: float, channels: int, codec: str) -> dict:
+    return {
+        "sample_rate": int(sample_rate),
+        "duration": float(duration),
+        "channels": int(channels),
+        "codec": codec,
+    }
+
+
+def parse_wav(f: BinaryIO, size: int) -> Optional[dict]:
+    header = f.read(12)
+    if header[0:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return None
+    fmt = None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            return None
+        chunk_id, chunk_size = struct.unpack("<4sI", chunk)
+        if chunk_id == b"fmt ":
+            fmt = f.read(chunk_size)
+            # chunks are word-aligned
+            f.seek(chunk_size & 1, 1)
+        elif chunk_id == b"data":
+            break
+        else:
+            f.seek(chunk_size + (chunk_size & 1), 1)
+    if not fmt or len(fmt) < 16:
+        return None
+    tag, channels, sample_rate, byte_rate, _, bits = struct.unpack("<HHIIHH", fmt[:16])
+    if tag == 0xFFFE and len(fmt) >= 26:
+        # WAVE_FORMAT_EXTENSIBLE, the format is in the subformat GUID
+        (tag,) = struct.unpack("<H", fmt[24:26])
+    if tag == 1:
+        codec = "pcm_u8" if bits == 8 else f"pcm_s{bits}le"
+    elif tag == 3:
+        codec = f"pcm_f{bits}le"
+    else:
+        return None
+    # the data chunk may be truncated or have a placeholder size
+    data_size = min(chunk_size, size - f.tell())
+    duration = data_size / byte_rate if byte_rate else 0.0
+    return make_info(sample_rate, duration, channels, codec)
+
+
+def parse_flac(f: BinaryIO, _: int) -> Optional[dict]:
+    header = f.read(8)
+    # STREAMINFO is always the first metadata block
+    if header[0:4] != b"fLaC" or header[4] & 0x7F != 0:
+        return None
+    info = f.read(18)
+    if len(info) < 18:
+        return None
+    (bits,) = struct.unpack(">Q", info[10:18])
+    sample_rate = bits >> 44
+    channels = ((bits >> 41) & 0x07) + 1
+    samples = bits & 0xFFFFFFFFF
+    if not sample_rate:
+        return None
+    return make_info(sample_rate, samples / sample_rate, channels, "flac")
+
+
+def parse_ogg(f: BinaryIO, size: int) -> Optional[dict]:
+    page = f.read(27)
+    if page[0:4] != b"OggS":
+        return None
+    segments = f.read(page[26])
+    packet = f.read(sum(segments))
+    if packet[0:8] == b"OpusHead":
+        codec = "opus"
+        channels = packet[9]
+        (pre_skip,) = struct.unpack("<H", packet[10:12])
+        # Opus is always decoded at 48 kHz
+        sample_rate = 48000
+    elif packet[0:7] == b"\x01vorbis":
+        codec = "vorbis"
+        channels = packet[11]
+        (sample_rate,) = struct.unpack("<I", packet[12:16])
+        pre_skip = 0
+    else:
+        return None
+    if not sample_rate:
+        return None
+    # the granule position of the last page is the total sample count
+    tail = min(size, 65536)
+    f.seek(size - tail)
+    data = f.read(tail)
+    last = data.rfind(b"OggS")
+    if last == -1 or last + 14 > len(data):
+        return None
+    (granule,) = struct.unpack("<q", data[last + 6 : last + 14])
+    duration = max(granule - pre_skip, 0) / sample_rate
+    return make_info(sample_rate, duration, channels, codec)
+
+
+def parse_mp3_header(header: bytes) -> Optional[Tuple[int, int, int, int, int]]:
+    # returns (version, sample_rate, bitrate, channels, frame_length)
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version = (header[1] >> 3) & 0x03
+    layer = (header[1] >> 1) & 0x03
+    bitrate_index = header[2] >> 4
+    rate_index = (header[2] >> 2) & 0x03
+    # only MPEG Layer III
+    if version == 1 or layer != 1 or rate_index == 3:
+        return None
+    if bitrate_index in (0, 15):
+        return None
+    if version == 3:
+        bitrate = MP3_BITRATES_V1[bitrate_index]
+    else:
+        bitrate = MP3_BITRATES_V2[bitrate_index]
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    padding = (header[2] >> 1) & 0x01
+    channels = 1 if header[3] >> 6 == 3 else 2
+    factor = 144 if version == 3 else 72
+    frame_length = factor * bitrate * 1000 // sample_rate + padding
+    return version, sample_rate, bitrate, channels, frame_length
+
+
+def parse_mp3(f: BinaryIO, size: int) -> Optional[dict]:
+    start = 0
+    header = f.read(10)
+    if header[0:3] == b"ID3":
+        # skip the ID3v2 tag, its size is a syncsafe integer
+        tag_size = 0
+        for byte in header[6:10]:
+            tag_size = (tag_size << 7) | (byte & 0x7F)
+        start = 10 + tag_size + (10 if header[5] & 0x10 else 0)
+    f.seek(start)
+    data = f.read(65536)
+
+    offset = data.find(b"\xff")
+    while offset != -1 and offset + 4 <= len(data):
+        frame = parse_mp3_header(data[offset : offset + 4])
+        # check the next frame to avoid false synchronization
+        if frame and parse_mp3_header(data[offset + frame[4] : offset + frame[4] + 4]):
+            break
+        offset = data.find(b"\xff", offset + 1)
+    else:
+        return None
+
+    version, sample_rate, bitrate, channels, _ = frame
+    samples = 1152 if version == 3 else 576
+    # the Xing/Info tag is placed after the side information
+    if version == 3:
+        side_info = 17 if channels == 1 else 32
+    else:
+        side_info = 9 if channels == 1 else 17
+    xing = offset + 4 + side_info
+    vbri = offset + 4 + 32
+    frames = 0
+    if data[xing : xing + 4] in (b"Xing", b"Info"):
+        (flags,) = struct.unpack(">I", data[xing + 4 : xing + 8])
+        if flags & 0x01:
+            (frames,) = struct.unpack(">I", data[xing + 8 : xing + 12])
+    elif data[vbri : vbri + 4] == b"VBRI":
+        (frames,) = struct.unpack(">I", data[vbri + 14 : vbri + 18])
+
+    if frames:
+        duration = frames * samples / sample_rate
+    else:
+        # constant bitrate
+        duration = (size - start - offset) * 8 / (bitrate * 1000)
+    return make_info(sample_rate, duration, channels, "mp3")
+
+
+def parse_audio(filename: str, size: int) -> Optional[dict]:
+    # read common formats without spawning ffprobe
+    with open(filename, "rb") as f:
+        magic = f.read(4)
+        f.seek(0)
+        if magic == b"RIFF":
+            return parse_wav(f, size)
+        if magic == b"fLaC":
+            return parse_flac(f, size)
+        if magic == b"OggS":
+            return parse_ogg(f, size)
+        if magic[0:3] == b"ID3" or magic[0:1] == b"\xff":
+            return parse_mp3(f, size)
+    return None
+
+
+def ffprobe(filename: str) -> Optional[dict]:
+    cmd = [
+        "ffprobe",
+        "-show_streams",
+        *("-of", "json"),
+        filename,
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    data = result.stdout.decode()
+    data = json.loads(data or "{}")
+    if not "streams" in data:
+        return None
+    data = [s for s in data["streams"] if s["codec_type"] == "audio"]
+    if not data:
+        return None
+    return data[0]
+
+
+def seek_points(filename: str, interval: float) -> List[Tuple[float, int]]:
+    # (time, byte offset) of packets at least 'interval' seconds apart
+    cmd = [
+        "ffprobe",
+        *("-v", "error"),
+        *("-select_streams", "a:0"),
+        *("-show_entries", "packet=pts_time,pos"),
+        *("-of", "csv=p=0"),
+        filename,
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        return []
+    points = []
+    for line in result.stdout.decode(errors="replace").splitlines():
+        pts, _, pos = line.partition(",")
+        try:
+            point = (float(pts), int(pos))
+        except ValueError:
+            continue
+        if not points or point[0] - points[-1][0] >= interval:
+            points.append(point)
+    return points
+
+
+def analyze(filename: str, duration: float) -> dict:
+    # integrated loudness, true peak and silence at both ends in one pass
+    cmd = [
+        "ffmpeg",
+        "-nostats",
+        *("-i", filename),
+        "-vn",
+        *(
+            "-af",
+            "ebur128=peak=true,"
+            f"silencedetect=noise={SILENCE_THRESHOLD}dB:d={SILENCE_MIN_DURATION}",
+        ),
+        *("-f", "null"),
+        "-",
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        return {}
+    text = result.stderr.decode(errors="replace")
+    # the summary is printed when the filter is closed
+    _, _, summary = text.rpartition("Summary:")
+    loudness = re.search(r"I:\s+(-?[\d.]+|-inf) LUFS", summary)
+    peak = re.search(r"Peak:\s+(-?[\d.]+|-inf) dBFS", summary)
+    if not loudness or not peak:
+        return {}
+
+    trim_start = 0.0
+    trim_end = None
+    starts = [float(s) for s in re.findall(r"silence_start: (-?[\d.]+)", text)]
+    ends = [float(s) for s in re.findall(r"silence_end: (-?[\d.]+)", text)]
+    if starts and starts[0] <= 0.01 and ends:
+        trim_start = ends[0]
+    # silence lasting until the end may not be closed by silence_end
+    if starts and (len(ends) < len(starts) or ends[-1] >= duration - 0.05):
+        if starts[-1] > trim_start:
+            trim_end = starts[-1]
+    if trim_end is not None and trim_end - trim_start < 0.5:
+        # (almost) completely silent file
+        trim_start, trim_end = 0.0, None
+
+    return {
+        "loudness": max(float(loudness.group(1)), -70.0),
+        "true_peak": max(float(peak.group(1)), -70.0),
+        "trim_start": trim_start,
+        "trim_end": trim_end,
+    }
+
+
+def probe(filename: str) -> Optional[dict]:
+    try:
+        st = stat(filename)
+    except OSError:
+        return None
+    key = (filename, st.st_size, st.st_mtime)
+    if key in probe_cache:
+        return probe_cache[key]
+
+    try:
+        info = parse_audio(filename, st.st_size)
+    except (OSError, struct.error, IndexError):
+        info = None
+    if not info:
+        data = ffprobe(filename)
+        if data:
+            info = make_info(
+                data["sample_rate"],
+                data.get("duration") or 0,
+                data["channels"],
+                data["codec_name"],
+            )
+    probe_cache[key] = info
+    return info
+
+
+def probe_all(filenames: Iterable[str]) -> List[Optional[dict]]:
+    # probe files concurrently in the worker pool
+    return list(probe_pool.map(probe, filenames))
+
+
+async def probe_async(filename: str) -> Optional[dict]:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(probe_pool, probe, filename)
@@ -0,0 +1,86 @@
+import re
+from typing import Dict, Iterable, List, Set
+
+
+def trigrams(text: str) -> Set[str]:
+    result = set()
+    for word in re.split(r"[^0-9a-z]+", text.lower()):
+        if not word:
+            continue
+        # pad the words, so that short words and word starts match too
+        word = f"  {word} "
+        for i in range(len(word) - 2):
+            result.add(word[i : i + 3])
+    return result
+
+
+class SearchIndex:
+    """Inverted trigram index, updated one document at a time."""
+
+    # {trigram: {...key}}
+    postings: Dict[str, Set[str]]
+    # {key: {...trigram}}
+    documents: Dict[str, Set[str]]
+
+    def __init__(self):
+        self.postings = {}
+        self.documents = {}
+
+    def add(self, key: str, texts: Iterable[str]):
+        self.remove(key)
+        grams = set()
+        for text in texts:
+            grams |= trigrams(text or "")
+        self.documents[key] = grams
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(key)
+
+    def remove(self, key: str):
+        for gram in self.documents.pop(key, ()):
+            keys = self.postings[gram]
+            keys.discard(key)
+            if not keys:
+                del self.postings[gram]
+
+    def search(self, query: str, limit: int, min_score: float = 0.0) -> List[str]:
+        grams = trigrams(query)
+        if not grams:
+            return []
+        counts: Dict[str, int] = {}
+        for gram in grams:
+            for key in self.postings.get(gram, ()):
+                counts[key] = counts.get(key, 0) + 1
+
+        def score(key: str) -> float:
+            # similarity of trigram sets, favors shorter documents
+            matched = counts[key]
+            return matched / (len(grams) + len(self.documents[key]) - matched)
+
+        results = [key for key in counts if counts[key] / len(grams) >= min_score]
+        results.sort(key=lambda key: (-counts[key], -score(key), key))
+        return results[0:limit]
+
+
+class CommandSearch:
+    """Search over command names, descriptions and file names."""
+
+    def __init__(self):
+        self.names = SearchIndex()
+        self.texts = SearchIndex()
+
+    def add(self, name: str, cmd: dict, filenames: List[str]):
+        self.names.add(name, [name])
+        self.texts.add(name, [name, cmd.get("help", None), *filenames])
+
+    def remove(self, name: str):
+        self.names.remove(name)
+        self.texts.remove(name)
+
+    def find(self, query: str, limit: int = 10) -> List[str]:
+        return self.texts.search(query, limit, min_score=0.3)
+
+    def suggest(self, name: str, limit: int = 3) -> List[str]:
+        return self.names.search(name, limit, min_score=0.4)
+
+
+command_search = CommandSearch()
@@ -10,13 +10,63 @@ def die(s: str):
     raise SystemExit(s)
 
 
-CMD_VERSION = 3
+CMD_VERSION = 6
 
 RANDOM_FILE = "random"
 MIDI_IMPL_NONE = "nomidi"
 MIDI_IMPL_FLUIDSYNTH = "fluidsynth"
 MIDI_IMPL_TIMIDITY = "timidity"
+BLOB_DIR = "blobs"
 PACK_ICON = b"\xf0\x9f\x93\x81".decode()
+RANDOM_MODE_UNIFORM = "uniform"
+RANDOM_MODE_DURATION = "duration"
+RANDOM_MODE_PLAYS = "plays"
+RANDOM_MODE_WEIGHT = "weight"
+RANDOM_MODES = [
+    RANDOM_MODE_UNIFORM,
+    RANDOM_MODE_DURATION,
+    RANDOM_MODE_PLAYS,
+    RANDOM_MODE_WEIGHT,
+]
+LIBRARY_SORT_NAME = "name"
+LIBRARY_SORT_NEWEST = "newest"
+LIBRARY_SORT_PLAYS = "plays"
+LIBRARY_SORTS = [
+    LIBRARY_SORT_NAME,
+    LIBRARY_SORT_NEWEST,
+    LIBRARY_SORT_PLAYS,
+]
+LIBRARY_FILTER_GUILD = "guild"
+LIBRARY_PAGE_SIZE = 20
+STATS_PERIOD_DAY = "day"
+STATS_PERIOD_WEEK = "week"
+STATS_PERIOD_ALL = "all"
+# {period: hours}
+STATS_PERIODS = {
+    STATS_PERIOD_DAY: 24,
+    STATS_PERIOD_WEEK: 7 * 24,
+    STATS_PERIOD_ALL: None,
+}
+STATS_TOP_COUNT = 5
+FILTER_CHAIN_LIMIT = 10
+SILENCE_THRESHOLD = -50
+SILENCE_MIN_DURATION = 0.3
+LOUDNESS_MAX_GAIN = 12.0
+TRUE_PEAK_LIMIT = -1.0
+STATS_SAVE_TIME = 60.0
+CATALOG_SAVE_TIME = 30.0
+# clips played over a track at the same time
+OVERLAY_LIMIT = 4
+# seconds between the points of a seek index
+SEEK_INDEX_INTERVAL = 5.0
+# formats without an index of their own, seeking them is estimated by ffmpeg
+SEEK_INDEX_EXTENSIONS = [".mp3", ".aac"]
+# seconds skipped by !ff and !rw by default
+SEEK_STEP = 10
+# uploads are written to the disk in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# attachments of an upload downloaded at the same time
+DOWNLOAD_CONCURRENCY = 3
 
 BOT_TOKEN = getenv("BOT_TOKEN") or die("Bot token not provided")
 DATA_PATH = getenv("DATA_PATH") or "data/"
@@ -24,8 +74,25 @@ UPLOAD_DIR = getenv("UPLOAD_DIR") or "uploads"
 ESPIONAGE_FILE = getenv("ESPIONAGE_FILE") or die("Espionage file not specified")
 FILES_JSON = getenv("FILES_JSON") or "files.json"
 SF2S_JSON = getenv("SF2S_JSON") or "soundfonts.json"
+PACKS_JSON = getenv("PACKS_JSON") or "packs.json"
+DATABASE = getenv("DATABASE") or "espionage.db"
 LOG_CSV = getenv("LOG_CSV") or "log.csv"
+PLAY_LOG = getenv("PLAY_LOG") or "plays.log"
+VARIANT_DIR = getenv("VARIANT_DIR") or "variants"
+VARIANT_CACHE_SIZE = int(getenv("VARIANT_CACHE_SIZE") or 1024) * 1024 * 1024
+PLAY_LOG_FLUSH_TIME = float(getenv("PLAY_LOG_FLUSH_TIME") or 30.0)
+PLAY_LOG_MAX_SIZE = int(getenv("PLAY_LOG_MAX_SIZE") or 16) * 1024 * 1024
 NICKNAME_STATUS = getenv("NICKNAME_STATUS") == "true"
+COMMAND_ROUTER = getenv("COMMAND_ROUTER") == "true"
+PREFETCH_TIME = float(getenv("PREFETCH_TIME") or 5.0)
+PROBE_WORKERS = int(getenv("PROBE_WORKERS") or 4)
+NORMALIZE_LOUDNESS = (getenv("NORMALIZE_LOUDNESS") or "true") == "true"
+LOUDNESS_TARGET = float(getenv("LOUDNESS_TARGET") or -16.0)
+INGEST_WORKERS = int(getenv("INGEST_WORKERS") or 2)
+OFFLOAD_WORKERS = int(getenv("OFFLOAD_WORKERS") or 4)
+RENDER_WORKERS = int(getenv("RENDER_WORKERS") or 2)
+OVERLAY_MAX_DURATION = float(getenv("OVERLAY_MAX_DURATION") or 10.0)
+OVERLAY_DUCKING = int(getenv("OVERLAY_DUCKING") or 50) / 100.0
 
 ACTIVITY_NAME = getenv("ACTIVITY_NAME") or "Espionage"
 
@@ -48,9 +115,17 @@ UPLOAD_DIR = UPLOAD_DIR.strip(sep + (altsep or ""))
 UPLOAD_PATH = join(DATA_PATH, UPLOAD_DIR, "")
 isdir(UPLOAD_PATH) or makedirs(UPLOAD_PATH, exist_ok=True)
 
+# ensure existing filtered variants path
+VARIANT_DIR = VARIANT_DIR.strip(sep + (altsep or ""))
+VARIANT_PATH = join(DATA_PATH, VARIANT_DIR, "")
+isdir(VARIANT_PATH) or makedirs(VARIANT_PATH, exist_ok=True)
+
 FILES_JSON = DATA_PATH + FILES_JSON
 SF2S_JSON = DATA_PATH + SF2S_JSON
+PACKS_JSON = DATA_PATH + PACKS_JSON
+DATABASE = DATA_PATH + DATABASE
 LOG_CSV = DATA_PATH + LOG_CSV
+PLAY_LOG = DATA_PATH + PLAY_LOG
 
 # join espionage file with data path if relative
 if not isabs(ESPIONAGE_FILE):
@@ -1,7 +1,14 @@
+from time import perf_counter
+
+# measure the time of importing all modules
+startup_mark = perf_counter()
+
 import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from os import makedirs, replace, sep
 from os.path import basename, dirname, isdir, isfile, join
+from typing import List
 
 import discord
 from discord import Activity, ActivityType, Intents
@@ -11,9 +18,40 @@ from discord.ext.commands import Bot
 from equalizer import Equalizer
 from espionage import Espionage
 from music import Music
-from settings import ACTIVITY_NAME, BOT_TOKEN, DATA_PATH, UPLOAD_DIR
+from settings import (
+    ACTIVITY_NAME,
+    BOT_TOKEN,
+    CMD_VERSION,
+    DATA_PATH,
+    PROBE_WORKERS,
+    UPLOAD_DIR,
+)
+from storage import (
+    TABLE_COMMANDS,
+    TABLE_SOUNDFONTS,
+    Storage,
+    import_json,
+    open_database,
+)
 from uploading import Uploading
-from utils import fill_audio_info, load_files, load_sf2s, save_files, save_sf2s
+from utils import fill_audio_analysis, fill_audio_info, refresh_opus_rendition
+
+# {stage: duration}
+startup_times = {}
+# storages with descriptors left for migrate_media()
+pending_migrations = []
+# keeps a reference to the running background migration
+migration_task = None
+
+
+def startup_stage(name: str):
+    global startup_mark
+    now = perf_counter()
+    startup_times[name] = now - startup_mark
+    startup_mark = now
+
+
+startup_stage("import")
 
 discord.utils.setup_logging(level=logging.INFO, root=False)
 
@@ -25,6 +63,13 @@ client = Bot(command_prefix=commands.when_mentioned_or("!"), intents=intents)
 @client.event
 async def on_ready():
     print("We have logged in as {0.user}".format(client))
+    if "ready" not in startup_times:
+        startup_stage("ready")
+        times = ", ".join(f"{k}: {v:.02f} s" for k, v in startup_times.items())
+        total = sum(startup_times.values())
+        print(f"Startup took {total:.02f} s ({times})")
+        global migration_task
+        migration_task = asyncio.create_task(migrate_media_all(pending_migrations))
     await client.change_presence(
         activity=Activity(
             type=ActivityType.listening,
@@ -57,33 +102,82 @@ def migrate(file: dict) -> bool:
         file["filename"] = basename(file["filename"])
         file["version"] = 2
         migrated = True
+    return migrated
+
+
+def migrate_media(file: dict) -> bool:
+    # probing, analysis and transcoding, done after logging in
+    version = file["version"]
+    if version >= CMD_VERSION:
+        return False
     if version < 3:
+        # analyzes the loudness too
         fill_audio_info(file)
-        file["version"] = 3
-        migrated = True
-    return migrated
+    if version < 5:
+        fill_audio_analysis(file)
+    if version < 6:
+        # transcoded once, with the loudness adjustments baked in,
+        # replacing the renditions of versions 4 and 5
+        refresh_opus_rendition(file)
+    file["version"] = CMD_VERSION
+    return True
+
+
+def migrate_all(items: Storage):
+    migrated = any([migrate(file) for file in items.values()])
+    if migrated:
+        items.save_all()
+    pending_migrations.append(items)
+
+
+async def migrate_media_all(storages: List[Storage]):
+    # the commands are playable meanwhile, using ffmpeg on the original files
+    loop = asyncio.get_running_loop()
+    # probing and transcoding run in subprocesses, threads are enough
+    pool = ThreadPoolExecutor(max_workers=PROBE_WORKERS, thread_name_prefix="migrate")
+
+    async def migrate_one(items: Storage, name: str, file: dict):
+        try:
+            if not await loop.run_in_executor(pool, migrate_media, file):
+                return
+        except Exception as e:
+            print(f"Couldn't migrate '{name}': {e!r}")
+            return
+        # descriptors are saved on the event loop, unless replaced meanwhile
+        if items.get(name, None) is file:
+            items.save(name)
+
+    start = perf_counter()
+    jobs = [
+        migrate_one(items, name, file)
+        for items in storages
+        for name, file in list(items.items())
+        if file["version"] < CMD_VERSION
+    ]
+    if jobs:
+        print(f"Migrating {len(jobs)} descriptors in the background...")
+        await asyncio.gather(*jobs)
+        print(f"Migration took {perf_counter() - start:.02f} s")
+    pool.shutdown()
 
 
 async def main():
-    files = load_files()
-    sf2s = load_sf2s()
+    db = open_database()
+    files = Storage(db, TABLE_COMMANDS)
+    sf2s = Storage(db, TABLE_SOUNDFONTS)
+    import_json(db, files, sf2s)
 
-    migrated = False
-    for file in files.values():
-        migrated = migrate(file) or migrated
-    if migrated:
-        save_files(files)
+    startup_stage("load")
 
-    migrated = False
-    for sf2 in sf2s.values():
-        migrated = migrate(sf2) or migrated
-    if migrated:
-        save_sf2s(sf2s)
+    migrate_all(files)
+    migrate_all(sf2s)
+    startup_stage("migrate")
 
     await client.add_cog(Espionage(bot=client, files=files, sf2s=sf2s))
     await client.add_cog(Music(bot=client, files=files, sf2s=sf2s))
     await client.add_cog(Uploading(bot=client, files=files, sf2s=sf2s))
     await client.add_cog(Equalizer(bot=client, files=files, sf2s=sf2s))
+    startup_stage("cogs")
     async with client:
         await client.start(BOT_TOKEN)
 
@@ -0,0 +1,200 @@
+import heapq
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from playlog import PlayRecord
+
+STATS_ALL = "all"
+STATS_COMMAND = "cmd"
+STATS_GUILD = "guild"
+STATS_USER = "user"
+# hourly rollups kept in memory
+STATS_HOURS = 7 * 24
+
+
+def current_hour() -> int:
+    return int(time()) // 3600
+
+
+class PlayStats:
+    """Play counters per command, guild and user, kept in memory.
+
+    Totals and hourly rollups are updated with every play and written to
+    the database periodically, so that !stats never reads the play log.
+    Until the logged plays are backfilled, nothing is written, so that the
+    plays are counted either by the backfill or live, never by both.
+    """
+
+    # {(kind, key): [name, plays, airtime]}
+    totals: Dict[Tuple[str, str], list]
+    # {hour: {(kind, key): [plays, airtime]}}
+    hourly: Dict[int, Dict[Tuple[str, str], list]]
+    # {(kind, key)}
+    dirty_totals: Set[Tuple[str, str]]
+    # {(hour, kind, key)}
+    dirty_hourly: Set[Tuple[int, str, str]]
+    # plays logged before this time are left to the backfill,
+    # None if it's already done
+    backfill_until: Optional[int]
+
+    def __init__(self, db: Optional[sqlite3.Connection]):
+        self.db = db
+        # plays are added from the player thread too
+        self.lock = Lock()
+        self.totals = {}
+        self.hourly = {}
+        self.dirty_totals = set()
+        self.dirty_hourly = set()
+        self.backfill_until = None
+        if not db:
+            return
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS stats_totals ("
+            "kind TEXT, key TEXT, name TEXT, plays INTEGER, airtime REAL, "
+            "PRIMARY KEY (kind, key)) WITHOUT ROWID"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS stats_hourly ("
+            "hour INTEGER, kind TEXT, key TEXT, plays INTEGER, airtime REAL, "
+            "PRIMARY KEY (hour, kind, key)) WITHOUT ROWID"
+        )
+        for kind, key, name, plays, airtime in db.execute(
+            "SELECT kind, key, name, plays, airtime FROM stats_totals"
+        ):
+            self.totals[(kind, key)] = [name, plays, airtime]
+        for hour, kind, key, plays, airtime in db.execute(
+            "SELECT hour, kind, key, plays, airtime FROM stats_hourly WHERE hour >= ?",
+            (current_hour() - STATS_HOURS + 1,),
+        ):
+            self.hourly.setdefault(hour, {})[(kind, key)] = [plays, airtime]
+        if not self.backfilled():
+            # fixed before counting any plays live
+            self.backfill_until = int(time())
+
+    def add(self, record: PlayRecord, name: str, duration: float):
+        hour = record.timestamp // 3600
+        entries = [
+            (STATS_ALL, "", ""),
+            (STATS_COMMAND, name, name),
+            (STATS_GUILD, str(record.guild_id), record.guild_name),
+            (STATS_USER, str(record.member_id), record.member_name),
+        ]
+        with self.lock:
+            rollup = self.hourly.setdefault(hour, {})
+            for kind, key, title in entries:
+                total = self.totals.setdefault((kind, key), [title, 0, 0.0])
+                # keep the latest guild and user names
+                total[0] = title
+                total[1] += 1
+                total[2] += duration
+                counter = rollup.setdefault((kind, key), [0, 0.0])
+                counter[0] += 1
+                counter[1] += duration
+                self.dirty_totals.add((kind, key))
+                self.dirty_hourly.add((hour, kind, key))
+
+    def merge(self, other: "PlayStats"):
+        with self.lock:
+            for (kind, key), (title, plays, airtime) in other.totals.items():
+                total = self.totals.setdefault((kind, key), [title, 0, 0.0])
+                total[1] += plays
+                total[2] += airtime
+                self.dirty_totals.add((kind, key))
+            for hour, rollup in other.hourly.items():
+                for (kind, key), (plays, airtime) in rollup.items():
+                    counter = self.hourly.setdefault(hour, {}).setdefault(
+                        (kind, key), [0, 0.0]
+                    )
+                    counter[0] += plays
+                    counter[1] += airtime
+                    self.dirty_hourly.add((hour, kind, key))
+
+    def save(self, backfilled: bool = False):
+        if self.backfill_until is not None and not backfilled:
+            # the live totals are saved together with the backfilled ones
+            return
+        with self.lock:
+            totals = [
+                (kind, key, *self.totals[(kind, key)])
+                for kind, key in self.dirty_totals
+            ]
+            hourly = [
+                (hour, kind, key, *self.hourly[hour][(kind, key)])
+                for hour, kind, key in self.dirty_hourly
+            ]
+            self.dirty_totals.clear()
+            self.dirty_hourly.clear()
+            # older rollups are only kept in the database
+            since = current_hour() - STATS_HOURS + 1
+            for hour in [hour for hour in self.hourly if hour < since]:
+                del self.hourly[hour]
+        if not totals and not hourly and not backfilled:
+            return
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO stats_totals VALUES (?, ?, ?, ?, ?)", totals
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO stats_hourly VALUES (?, ?, ?, ?, ?)", hourly
+            )
+            if backfilled:
+                until = str(self.backfill_until)
+                self.db.execute(
+                    "INSERT INTO meta VALUES ('stats_backfilled', ?)", (until,)
+                )
+        self.backfill_until = None
+
+    def plays(self, kind: str, key: str) -> int:
+        with self.lock:
+            total = self.totals.get((kind, key), None)
+        return total[1] if total else 0
+
+    def backfilled(self) -> bool:
+        query = "SELECT 1 FROM meta WHERE key = 'stats_backfilled'"
+        return self.db.execute(query).fetchone() is not None
+
+    def top(
+        self, kind: str, hours: Optional[int], limit: int
+    ) -> List[Tuple[str, int, float]]:
+        # returns [(name, plays, airtime)], of all time if hours is None
+        with self.lock:
+            if hours is None:
+                items = [
+                    tuple(total) for (k, _), total in self.totals.items() if k == kind
+                ]
+            else:
+                counts: Dict[str, list] = {}
+                now = current_hour()
+                for hour in range(now - min(hours, STATS_HOURS) + 1, now + 1):
+                    for (k, key), (plays, airtime) in self.hourly.get(hour, {}).items():
+                        if k != kind:
+                            continue
+                        count = counts.setdefault(key, [0, 0.0])
+                        count[0] += plays
+                        count[1] += airtime
+                items = [
+                    (self.totals.get((kind, key), [key])[0], plays, airtime)
+                    for key, (plays, airtime) in counts.items()
+                ]
+        return heapq.nlargest(limit, items, key=lambda item: item[1])
+
+
+def backfill_stats(
+    records: Iterable[PlayRecord], resolve, until: int
+) -> Tuple[PlayStats, int]:
+    # resolve(record) returns (command name or None, duration)
+    stats = PlayStats(None)
+    count = 0
+    for record in records:
+        # later plays are already counted
+        if record.timestamp >= until:
+            continue
+        name, duration = resolve(record)
+        if not name:
+            continue
+        stats.add(record, name, duration)
+        count += 1
+    return stats, count
@@ -0,0 +1,115 @@
+import json
+import sqlite3
+from typing import Dict, List
+
+from settings import DATABASE
+from utils import load_files, load_sf2s
+
+TABLE_COMMANDS = "commands"
+TABLE_SOUNDFONTS = "soundfonts"
+
+
+def open_database() -> sqlite3.Connection:
+    db = sqlite3.connect(DATABASE, isolation_level=None)
+    # readers don't block the writer, a crash can't truncate the database
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    for table in [TABLE_COMMANDS, TABLE_SOUNDFONTS]:
+        db.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "name TEXT PRIMARY KEY, "
+            "author_id INTEGER, "
+            "guild_id INTEGER, "
+            "data TEXT NOT NULL)"
+        )
+        db.execute(f"CREATE INDEX IF NOT EXISTS {table}_author ON {table} (author_id)")
+        db.execute(f"CREATE INDEX IF NOT EXISTS {table}_guild ON {table} (guild_id)")
+    return db
+
+
+class Storage(dict):
+    """Descriptors kept in memory and persisted to SQLite row by row.
+
+    Assigning or removing a key updates its row. Descriptors modified
+    in place have to be written with save(). The version is incremented
+    with every write, to invalidate caches built from the descriptors.
+    """
+
+    def __init__(self, db: sqlite3.Connection, table: str):
+        super().__init__()
+        self.db = db
+        self.table = table
+        self.version = 0
+        for name, data in db.execute(f"SELECT name, data FROM {table}"):
+            super().__setitem__(name, json.loads(data))
+
+    @staticmethod
+    def _row(name: str, item: dict) -> tuple:
+        author = item.get("author", None) or {}
+        return (
+            name,
+            author.get("id", None),
+            author.get("guild", None),
+            json.dumps(item),
+        )
+
+    def save(self, name: str):
+        self.version += 1
+        self.db.execute(
+            f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)",
+            self._row(name, self[name]),
+        )
+
+    def save_all(self):
+        self.version += 1
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.executemany(
+                f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)",
+                [self._row(name, item) for name, item in self.items()],
+            )
+
+    def __setitem__(self, name: str, item: dict):
+        super().__setitem__(name, item)
+        self.save(name)
+
+    def __delitem__(self, name: str):
+        super().__delitem__(name)
+        self.version += 1
+        self.db.execute(f"DELETE FROM {self.table} WHERE name = ?", (name,))
+
+    def pop(self, name: str, *default):
+        if name not in self:
+            return super().pop(name, *default)
+        item = self[name]
+        del self[name]
+        return item
+
+    def by_author(self, author_id: int) -> List[str]:
+        rows = self.db.execute(
+            f"SELECT name FROM {self.table} WHERE author_id = ?",
+            (author_id,),
+        )
+        return [name for (name,) in rows]
+
+    def by_guild(self, guild_id: int) -> List[str]:
+        rows = self.db.execute(
+            f"SELECT name FROM {self.table} WHERE guild_id = ?",
+            (guild_id,),
+        )
+        return [name for (name,) in rows]
+
+
+def import_json(db: sqlite3.Connection, files: Storage, sf2s: Storage):
+    # one-shot import of FILES_JSON and SF2S_JSON
+    if db.execute("SELECT 1 FROM meta WHERE key = 'imported'").fetchone():
+        return
+    imported: Dict[str, dict] = load_files()
+    dict.update(files, imported)
+    files.save_all()
+    imported = load_sf2s()
+    dict.update(sf2s, imported)
+    sf2s.save_all()
+    db.execute("INSERT INTO meta VALUES ('imported', '1')")
+    print(f"Imported {len(files)} commands and {len(sf2s)} SoundFonts.")
@@ -0,0 +1,14 @@
+import os
+import sys
+from os.path import dirname, join
+from tempfile import mkdtemp
+
+# the modules live in the repository root
+sys.path.insert(0, dirname(dirname(__file__)))
+
+# settings are read from the environment when they're first imported
+DATA_PATH = mkdtemp(prefix="espionage-test-")
+open(join(DATA_PATH, "espionage.mp3"), "wb").close()
+os.environ["BOT_TOKEN"] = "test"
+os.environ["DATA_PATH"] = DATA_PATH
+os.environ["ESPIONAGE_FILE"] = "espionage.mp3"
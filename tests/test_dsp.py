@@ -0,0 +1,69 @@
+from types import SimpleNamespace
+
+import pytest
+from discord import AudioSource, opus
+
+from dsp import MixerAudio, attach_mixer, dsp_available
+from utils import ClockedAudio
+
+FRAME_SIZE = 960
+FRAME = b"\x10\x00\x20\x00" * FRAME_SIZE
+
+
+def opus_loaded() -> bool:
+    return opus.is_loaded() or opus._load_default()
+
+
+pytestmark = pytest.mark.skipif(
+    not dsp_available() or not opus_loaded(), reason="needs NumPy and libopus"
+)
+
+
+class PCMAudio(AudioSource):
+    def __init__(self, frames: int):
+        self.frames = frames
+
+    def read(self) -> bytes:
+        if not self.frames:
+            return b""
+        self.frames -= 1
+        return FRAME
+
+    def is_opus(self) -> bool:
+        return False
+
+
+class OpusAudio(PCMAudio):
+    def __init__(self, frames: int):
+        super().__init__(frames)
+        self.encoder = opus.Encoder()
+
+    def read(self) -> bytes:
+        data = super().read()
+        return data and self.encoder.encode(data, FRAME_SIZE)
+
+    def is_opus(self) -> bool:
+        return True
+
+
+def test_overlay_on_opus_source():
+    # the player didn't create an encoder for the Opus source
+    voice = SimpleNamespace(source=ClockedAudio(OpusAudio(10)), encoder=None)
+    mixer = attach_mixer(voice, 0.5, 4)
+    assert voice.source is mixer
+    assert voice.encoder
+
+    # passed through without clips
+    assert mixer.read()
+    assert mixer.is_opus()
+
+    mixer.add(PCMAudio(2))
+    data = mixer.read()
+    assert not mixer.is_opus()
+    assert len(data) == len(FRAME)
+    # the player encodes the mixed frame
+    assert voice.encoder.encode(data, FRAME_SIZE)
+
+    # the mixer is reused by the next clip
+    assert attach_mixer(voice, 0.5, 4) is mixer
+    assert isinstance(voice.source, MixerAudio)
@@ -0,0 +1,23 @@
+from filterchain import played_duration, seek_filters
+
+INFO = {
+    "duration": 10.0,
+    "loudness": -16.0,
+    "true_peak": -3.0,
+    "trim_start": 1.5,
+    "trim_end": 9.0,
+}
+
+
+def test_played_duration():
+    assert played_duration(INFO) == 7.5
+    assert played_duration(dict(INFO, trim_end=None)) == 8.5
+    assert played_duration({"duration": 10.0}) == 10.0
+    assert played_duration(None) == 0.0
+
+
+def test_seek_filters_trimmed_position():
+    filters = ["atrim=start=1.500:end=9.000", "asetpts=PTS-STARTPTS", "volume=2.0dB"]
+    filters, seek = seek_filters(filters, 2.0)
+    assert seek == 3.5
+    assert filters == ["atrim=end=5.500", "asetpts=PTS-STARTPTS", "volume=2.0dB"]
@@ -0,0 +1,38 @@
+from playlog import PlayRecord, parse_csv_line
+
+
+def make_record(**fields) -> PlayRecord:
+    record = PlayRecord(
+        timestamp=1600000000,
+        guild_id=1,
+        guild_name="guild",
+        member_id=2,
+        member_name="member#1234",
+        cmd="cmd",
+        filename="1600000000_file.mp3",
+        speed=100,
+    )
+    record.__dict__.update(fields)
+    return record
+
+
+def test_parse_csv_line():
+    record = make_record(speed=150)
+    assert parse_csv_line(record.csv_line()) == record
+
+
+def test_parse_csv_line_separator_in_names():
+    for fields in [
+        dict(filename="f;n.mp3"),
+        dict(guild_name="a;1;b"),
+        dict(guild_name="g;h", filename="pack/1;2.mp3"),
+    ]:
+        record = make_record(**fields)
+        assert parse_csv_line(record.csv_line()) == record
+
+
+def test_parse_invalid_csv_line():
+    assert parse_csv_line("") is None
+    assert parse_csv_line("1;2;guild") is None
+    assert parse_csv_line("x;2;guild;3;m#1;cmd;file;100%") is None
+    assert parse_csv_line("1;2;guild;3;m#1;cmd;file;100") is None
@@ -0,0 +1,45 @@
+import sqlite3
+
+from playlog import PlayRecord
+from stats import STATS_COMMAND, PlayStats, backfill_stats
+
+
+def open_db() -> sqlite3.Connection:
+    db = sqlite3.connect(":memory:", isolation_level=None)
+    db.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)")
+    return db
+
+
+def make_record(timestamp: int) -> PlayRecord:
+    return PlayRecord(
+        timestamp=timestamp,
+        guild_id=1,
+        guild_name="guild",
+        member_id=2,
+        member_name="member#1234",
+        cmd="cmd",
+        filename="file.mp3",
+        speed=100,
+    )
+
+
+def test_backfill_after_restart():
+    db = open_db()
+    stats = PlayStats(db)
+    until = stats.backfill_until
+    assert until is not None
+    stats.add(make_record(until), "cmd", 1.0)
+    # not saved before the backfill
+    stats.save()
+    assert PlayStats(db).plays(STATS_COMMAND, "cmd") == 0
+
+    # the live play is in the log too, but after the cutoff
+    log = [make_record(until - 10), make_record(until)]
+    backfilled, count = backfill_stats(log, lambda _: ("cmd", 1.0), until)
+    assert count == 1
+    stats.merge(backfilled)
+    stats.save(backfilled=True)
+
+    stats = PlayStats(db)
+    assert stats.backfill_until is None
+    assert stats.plays(STATS_COMMAND, "cmd") == 2
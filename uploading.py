@@ -1,35 +1,65 @@
-from os import mkdir, replace, unlink
+import asyncio
+from os import replace, unlink
 from os.path import basename, isdir, isfile, join
-from pathlib import Path
-from shutil import rmtree
+from shutil import copyfile, rmtree
 from time import time
-from typing import Dict
+from typing import List, Set, Tuple
 
-import patoolib
-from discord import Message
+from discord import Attachment, Message
 from discord.ext import commands
-from discord.ext.commands import Bot, Cog, Context
-from sf2utils.sf2parse import Sf2File
-
-from settings import CMD_VERSION, COG_ESPIONAGE, COG_UPLOADING, UPLOAD_PATH
+from discord.ext.commands import Bot, Cog, CommandError, Context
+
+from blobs import BlobStore
+from ingest import IngestJob, download, extract_archive, ingest_pool
+from probe import probe_pool
+from settings import (
+    CMD_VERSION,
+    COG_ESPIONAGE,
+    COG_UPLOADING,
+    DOWNLOAD_CONCURRENCY,
+    INGEST_WORKERS,
+    UPLOAD_PATH,
+)
+from storage import Storage
 from utils import (
-    check_file,
+    check_buffer,
     ensure_can_modify,
     ensure_command,
     fill_audio_info,
+    fill_opus_rendition,
+    offload,
     pack_dirname,
     real_filename,
-    save_files,
-    save_sf2s,
+    remove_opus_rendition,
+    remove_seek_index,
 )
 
 
 class Uploading(Cog, name=COG_UPLOADING):
-    def __init__(self, bot: Bot, files: Dict[str, dict], sf2s: Dict[str, str]):
+    def __init__(self, bot: Bot, files: Storage, sf2s: Storage):
         self.bot = bot
         self.files = files
         self.sf2s = sf2s
         self.espionage = self.bot.get_cog(COG_ESPIONAGE)
+        self.blobs = BlobStore(files)
+        self.ingest_queue: asyncio.Queue = asyncio.Queue()
+        self.workers: List[asyncio.Task] = []
+        # names of the commands being uploaded
+        self.ingesting: Set[str] = set()
+
+    def remove_file(self, cmd: dict):
+        # deduplicated files are removed when no longer referenced
+        if "hash" in cmd:
+            self.blobs.release(cmd)
+            return
+        remove_opus_rendition(cmd)
+        filename = real_filename(cmd)
+        if isfile(filename):
+            remove_seek_index(filename)
+            unlink(filename)
+        elif isdir(filename):
+            rmtree(filename)
+            self.espionage.catalog.remove(filename)
 
     @commands.command()
     async def pack(self, ctx: Context, name: str = None):
@@ -52,23 +82,262 @@ class Uploading(Cog, name=COG_UPLOADING):
 
         dirname = pack_dirname(join(UPLOAD_PATH, f"{int(time())}_{name}"))
         old_filename = real_filename(cmd)
-        old_basename = basename(cmd["filename"])
-        new_filename = join(dirname, old_basename)
-        replace(old_filename, new_filename)
+        if "hash" in cmd:
+            # the file may be shared with other commands
+            new_filename = join(dirname, f"{int(time())}_{cmd['original']}")
+            await offload(copyfile, old_filename, new_filename)
+            await offload(self.blobs.release, cmd)
+            for key in ["hash", "original", "opus", "opus_filters"]:
+                cmd.pop(key, None)
+        else:
+            # pack tracks are played from their original files
+            await offload(remove_opus_rendition, cmd)
+            await offload(remove_seek_index, old_filename)
+            new_filename = join(dirname, basename(cmd["filename"]))
+            await offload(replace, old_filename, new_filename)
 
         cmd["filename"] = basename(dirname)
         cmd["pack"] = True
+        cmd.pop("info", None)
+        await offload(self.espionage.catalog.update, real_filename(cmd))
 
         # remove the command to update help text
         self.espionage.remove_command(name)
         self.espionage.add_command(name)
 
-        # save the command descriptors
-        save_files(self.files)
+        # save the command descriptor
+        self.files.save(name)
         await ctx.send(
             f":v: Converted `!{name}` as a music pack. Try uploading more files with `!upload {name}`.",
         )
 
+    async def cog_load(self):
+        for _ in range(INGEST_WORKERS):
+            self.workers.append(asyncio.create_task(self.ingest_worker()))
+
+    async def cog_unload(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers.clear()
+
+    async def ingest_worker(self):
+        while True:
+            job: IngestJob = await self.ingest_queue.get()
+            try:
+                await self.ingest(job)
+            except CommandError:
+                # the user was already notified
+                await job.progress.delete()
+            except Exception as e:
+                print(f"Upload of !{job.name} failed: {e!r}")
+                await job.fail(f":x: Couldn't upload `!{job.name}`.")
+            finally:
+                self.ingesting.discard(job.name)
+                self.ingest_queue.task_done()
+
+    async def ingest(self, job: IngestJob):
+        loop = self.bot.loop
+        name = job.name
+        cmd = job.cmd
+
+        if job.pack and not job.existing:
+            # create a new pack
+            job.dirname = pack_dirname(join(UPLOAD_PATH, f"{int(time())}_{name}"))
+
+        async def fetch(index: int, attachment: Attachment) -> Tuple[str, bytes, str]:
+            # downloaded under a temporary name, renamed when processed
+            part = join(UPLOAD_PATH, f".{int(time())}_{index}_{attachment.filename}")
+            async with semaphore:
+                header, digest = await download(attachment, part)
+            return part, header, digest
+
+        # download a few files at a time, straight to the disk
+        await job.update(f"Downloading **{len(job.attachments)}** file(s)...")
+        semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+        downloads = [
+            asyncio.create_task(fetch(index, attachment))
+            for index, attachment in enumerate(job.attachments)
+        ]
+
+        filename = ""
+        digest = ""
+        try:
+            # process the files in order, as they're downloaded
+            for attachment, task in zip(job.attachments, downloads):
+                part, header, path_digest = await task
+                path = join(UPLOAD_PATH, f"{int(time())}_{attachment.filename}")
+                await offload(replace, part, path)
+                (audvid, archive, soundfont, midi, video) = await loop.run_in_executor(
+                    ingest_pool, check_buffer, header
+                )
+                job.midi = job.midi or midi
+                job.video = job.video or video
+
+                # save all files from the archive
+                if archive:
+                    if not job.pack:
+                        # cannot replace single with multiple files
+                        if job.existing:
+                            await offload(unlink, path)
+                            await job.fail(f":x: Use `!pack {name}` first.")
+                            return
+                        # create a new pack
+                        job.pack = True
+                        job.dirname = pack_dirname(
+                            join(UPLOAD_PATH, f"{int(time())}_{attachment.filename}")
+                        )
+                    await job.update(f"Extracting **{attachment.filename}**...")
+                    try:
+                        await loop.run_in_executor(
+                            ingest_pool, extract_archive, job, path
+                        )
+                    finally:
+                        await offload(unlink, path)
+
+                # save audio/video files
+                elif audvid:
+                    filename = path
+                    digest = path_digest
+                    if job.pack:
+                        filename = join(job.dirname, basename(path))
+                        await offload(replace, path, filename)
+                    job.saved(attachment.filename)
+
+                # save soundfonts only with single file
+                elif soundfont and job.single and not job.existing:
+                    try:
+                        await self.ingest_soundfont(job, attachment, path)
+                    except CommandError:
+                        await offload(unlink, path)
+                        raise
+                    return
+
+                # discard everything else
+                else:
+                    await offload(unlink, path)
+                    job.invalid(attachment.filename)
+        finally:
+            for task in downloads:
+                if not task.done():
+                    # removes its partial file
+                    task.cancel()
+                elif not task.cancelled() and not task.exception():
+                    part = task.result()[0]
+                    if await offload(isfile, part):
+                        await offload(unlink, part)
+
+        # raise an error if no files saved
+        if not job.saved_count:
+            await job.fail(f":x: Unrecognized file: **{job.invalid_name}**")
+            if job.pack and not job.existing:
+                await offload(rmtree, job.dirname)
+            return
+
+        # store single files by their content hash
+        if not job.pack:
+            filename = await offload(self.blobs.store, filename, digest, job.saved_name)
+
+        # delete the replaced file
+        if not job.pack and job.existing:
+            await offload(self.remove_file, cmd)
+
+        # save cmd for new pack or replaced file
+        if not job.pack or not job.existing:
+            cmd = {
+                "filename": filename if not job.pack else basename(job.dirname),
+                "help": f"Uploaded by {job.ctx.author}",
+                "loop": True,
+                "author": {
+                    "id": job.ctx.author.id,
+                    "guild": job.ctx.guild.id if job.ctx.guild else None,
+                },
+                "version": CMD_VERSION,
+                "uploaded": int(time()),
+            }
+            if not job.pack:
+                cmd["hash"] = digest
+                cmd["original"] = job.saved_name
+                await job.update(f"Processing **{job.saved_name}**...")
+                await loop.run_in_executor(probe_pool, fill_audio_info, cmd)
+                await loop.run_in_executor(ingest_pool, fill_opus_rendition, cmd)
+
+        # save filtering flags
+        if job.pack:
+            cmd["pack"] = True
+        if job.midi:
+            cmd["midi"] = True
+            if "sf2s" not in cmd:
+                cmd["sf2s"] = []
+        if job.video:
+            cmd["video"] = True
+        if job.pack:
+            # index and probe the new tracks
+            await job.update(f"Processing **{job.saved_count}** file(s)...")
+            await loop.run_in_executor(
+                ingest_pool, self.espionage.catalog.update, real_filename(cmd)
+            )
+        # save the command descriptor
+        self.files[name] = cmd
+
+        # add the command to the music cog
+        self.espionage.add_command(name)
+
+        if job.pack and job.existing and job.saved_count == 1:
+            text = f":v: Added **{job.saved_name}** to `!{name}`."
+        elif job.saved_count > 1:
+            text = f":v: Uploaded **{job.saved_count}** file(s) to `!{name}`."
+        elif not job.existing:
+            text = f":v: File **{job.saved_name}** uploaded as `!{name}`."
+        else:
+            text = f":v: Replaced `!{name}` with **{job.saved_name}**."
+
+        if job.invalid_count == 1:
+            text += f"\n:x: File **{job.invalid_name}** was unrecognized."
+        elif job.invalid_count:
+            text += f"\n:x: **{job.invalid_count}** file(s) were unrecognized."
+
+        await job.progress.edit(content=text)
+
+    async def ingest_soundfont(
+        self, job: IngestJob, attachment: Attachment, filename: str
+    ):
+        name = job.name
+        # find a soundfont with this name
+        if name in self.sf2s:
+            sf2 = self.sf2s[name]
+            await ensure_can_modify(job.ctx, sf2)
+            # unlink to replace with another
+            await offload(unlink, real_filename(sf2))
+
+        def parse() -> str:
+            from sf2utils.sf2parse import Sf2File
+
+            with open(filename, "rb") as f:
+                sf2 = Sf2File(f)
+                if b"INAM" in sf2.raw.info:
+                    return sf2.raw.info[b"INAM"]
+            return attachment.filename
+
+        sf2_name = await self.bot.loop.run_in_executor(ingest_pool, parse)
+        if isinstance(sf2_name, bytes):
+            sf2_name = sf2_name.replace(b"\x00", b"").decode().strip()
+
+        sf2 = {
+            "filename": basename(filename),
+            "help": sf2_name,
+            "author": {
+                "id": job.ctx.author.id,
+                "guild": job.ctx.guild.id if job.ctx.guild else None,
+            },
+            "version": CMD_VERSION,
+        }
+
+        # save the soundfont descriptor
+        self.sf2s[name] = sf2
+        await job.progress.edit(
+            content=f":v: Added **{sf2_name}**! Use `!sf <midi name> {name}` to apply the SoundFont.",
+        )
+
     @commands.command()
     async def upload(self, ctx: Context, name: str = None):
         """Upload the attached file(s) as a command."""
@@ -84,11 +353,11 @@ class Uploading(Cog, name=COG_UPLOADING):
             await ctx.send(":x: You must add at least one attachment.", delete_after=3)
             return
 
-        cmd = None
-        # to make lint happy
-        filename = ""
+        if name in self.ingesting:
+            await ctx.send(f":x: `!{name}` is already being uploaded.", delete_after=3)
+            return
 
-        # helper variables for the process
+        cmd = None
         pack = False
         existing = False
         count = len(message.attachments)
@@ -96,11 +365,6 @@ class Uploading(Cog, name=COG_UPLOADING):
         midi = False
         video = False
 
-        saved_count = 0
-        saved_name = ""
-        invalid_count = 0
-        invalid_name = ""
-
         # replace the command or add to a pack
         if name in self.files:
             cmd = self.files[name]
@@ -119,176 +383,24 @@ class Uploading(Cog, name=COG_UPLOADING):
         # enable pack for multiple attachments
         pack = pack or not single
 
-        if pack:
-            if existing:
-                # store to an existing pack
-                dirname = real_filename(cmd)
-            else:
-                # create a new pack
-                dirname = pack_dirname(join(UPLOAD_PATH, f"{int(time())}_{name}"))
-        else:
-            # single file - store directly to uploads
-            dirname = UPLOAD_PATH
-
-        # save all attachments
-        for attachment in message.attachments:
-            # create a safe filename
-            filename = join(dirname, f"{int(time())}_{attachment.filename}")
-            # save the attachment
-            with open(filename, "wb") as f:
-                await attachment.save(f)
-
-            (audvid, archive, soundfont, midi1, video1) = check_file(filename)
-            midi = midi or midi1
-            video = video or video1
-
-            # save all files from the archive
-            if archive:
-                if not pack:
-                    # cannot replace single with multiple files
-                    if existing:
-                        await ctx.send(f":x: Use `!pack {name}` first.", delete_after=3)
-                        unlink(filename)
-                        return
-                    # create a new pack
-                    pack = True
-                    dirname = pack_dirname(filename)
-                # prepare a temporary directory
-                dirname_tmp = f"{dirname}_tmp"
-                if not isdir(dirname_tmp):
-                    mkdir(dirname_tmp)
-                # unpack the archive
-                patoolib.extract_archive(filename, outdir=dirname_tmp)
-                unlink(filename)
-                # search for compatible files
-                for path in Path(dirname_tmp).rglob("*"):
-                    path = str(path)
-                    filename = basename(path)
-                    if not isfile(path):
-                        continue
-
-                    (audvid, archive, soundfont, midi1, video1) = check_file(path)
-                    midi = midi or midi1
-                    video = video or video1
-
-                    if audvid:
-                        saved_count += 1
-                        saved_name = filename
-                        filename = join(dirname, filename)
-                        replace(path, filename)
-                    # elif soundfont:
-                    #     pass
-                    else:
-                        invalid_count += 1
-                        invalid_name = filename
-                # delete the temporary directory
-                rmtree(dirname_tmp)
-
-            # save audio/video files
-            elif audvid:
-                saved_count += 1
-                saved_name = attachment.filename
-
-            # save soundfonts only with single file
-            elif soundfont and single and not existing:
-                # find a soundfont with this name
-                if name in self.sf2s:
-                    sf2 = self.sf2s[name]
-                    await ensure_can_modify(ctx, sf2)
-                    # unlink to replace with another
-                    unlink(real_filename(sf2))
-
-                with open(filename, "rb") as f:
-                    sf2 = Sf2File(f)
-
-                sf2_name = (
-                    sf2.raw.info[b"INAM"]
-                    if b"INAM" in sf2.raw.info
-                    else attachment.filename
-                )
-                if isinstance(sf2_name, bytes):
-                    sf2_name = sf2_name.replace(b"\x00", b"").decode().strip()
-
-                sf2 = {
-                    "filename": basename(filename),
-                    "help": sf2_name,
-                    "author": {
-                        "id": ctx.author.id,
-                        "guild": ctx.guild.id if ctx.guild else None,
-                    },
-                    "version": CMD_VERSION,
-                }
-
-                self.sf2s[name] = sf2
-                save_sf2s(self.sf2s)
-                await ctx.send(
-                    f":v: Added **{sf2_name}**! Use `!sf <midi name> {name}` to apply the SoundFont.",
-                )
-                return
-
-            # discard everything else
-            else:
-                invalid_count += 1
-                invalid_name = attachment.filename
-                unlink(filename)
-
-        # raise an error if no files saved
-        if not saved_count:
-            await ctx.send(f":x: Unrecognized file: **{invalid_name}**", delete_after=3)
-            # to be safe
-            if isfile(filename):
-                unlink(filename)
-            return
-
-        # delete the replaced file
-        if not pack and existing:
-            unlink(real_filename(cmd))
-
-        # save cmd for new pack or replaced file
-        if not pack or not existing:
-            cmd = {
-                "filename": basename(filename if not pack else dirname),
-                "help": f"Uploaded by {ctx.author}",
-                "loop": True,
-                "author": {
-                    "id": ctx.author.id,
-                    "guild": ctx.guild.id if ctx.guild else None,
-                },
-                "version": CMD_VERSION,
-            }
-            fill_audio_info(cmd)
-
-        # save filtering flags
-        if pack:
-            cmd["pack"] = True
-        if midi:
-            cmd["midi"] = True
-            if "sf2s" not in cmd:
-                cmd["sf2s"] = []
-        if video:
-            cmd["video"] = True
-        self.files[name] = cmd
-
-        # add the command to the music cog
-        self.espionage.add_command(name)
-        # save the command descriptors
-        save_files(self.files)
-
-        if pack and existing and saved_count == 1:
-            text = f":v: Added **{saved_name}** to `!{name}`."
-        elif saved_count > 1:
-            text = f":v: Uploaded **{saved_count}** file(s) to `!{name}`."
-        elif not existing:
-            text = f":v: File **{saved_name}** uploaded as `!{name}`."
-        else:
-            text = f":v: Replaced `!{name}` with **{saved_name}**."
-
-        if invalid_count == 1:
-            text += f"\n:x: File **{invalid_name}** was unrecognized."
-        elif invalid_count:
-            text += f"\n:x: **{invalid_count}** file(s) were unrecognized."
-
-        await ctx.send(text)
+        # the files are processed in the background
+        self.ingesting.add(name)
+        progress = await ctx.send(f":hourglass: Queued **{count}** file(s)...")
+        job = IngestJob(
+            ctx=ctx,
+            name=name,
+            cmd=cmd,
+            attachments=list(message.attachments),
+            progress=progress,
+            pack=pack,
+            existing=existing,
+            single=single,
+            # store to an existing pack
+            dirname=real_filename(cmd) if pack and existing else "",
+            midi=midi,
+            video=video,
+        )
+        await self.ingest_queue.put(job)
 
     @commands.command()
     async def aremove(self, ctx: Context, name: str = None):
@@ -302,17 +414,13 @@ class Uploading(Cog, name=COG_UPLOADING):
         # get the command or raise an error
         cmd = await ensure_command(ctx, name, self.files)
         await ensure_can_modify(ctx, cmd)
-        # remove the command
+        # remove the command and its descriptor
         self.espionage.remove_command(name)
         self.files.pop(name, None)
-        filename = real_filename(cmd)
-        if isfile(filename):
-            unlink(filename)
-        elif isdir(filename):
-            rmtree(filename)
+        # stop picking the command in the weighted !random modes
+        self.espionage.update_weights(name)
+        await offload(self.remove_file, cmd)
 
-        # save the command descriptors
-        save_files(self.files)
         await ctx.send(f":v: Command `!{name}` removed.")
 
     @commands.command()
@@ -333,6 +441,6 @@ class Uploading(Cog, name=COG_UPLOADING):
         cmd["help"] = description
         self.espionage.add_command(name)
 
-        # save the command descriptors
-        save_files(self.files)
+        # save the command descriptor
+        self.files.save(name)
         await ctx.send(f":v: Description of `!{name}` set to `{description}`.")
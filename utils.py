@@ -1,13 +1,26 @@
+import asyncio
+import hashlib
 import json
+import struct
 import subprocess
 import sys
+from array import array
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from os import mkdir
-from os.path import isabs, isdir, isfile, join
-from shlex import quote, split
-from typing import Dict, List, Optional, Tuple, Union
+from mmap import ACCESS_READ, mmap
+from os import mkdir, replace, unlink
+from os.path import basename, isabs, isdir, isfile, join, relpath, splitext
+from random import random, randrange
+from shlex import quote
+from shlex import split as shlex_split
+from threading import Lock, get_ident
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 from discord import (
+    AudioSource,
     ClientException,
     FFmpegOpusAudio,
     Guild,
@@ -16,8 +29,11 @@ from discord import (
     VoiceClient,
 )
 from discord.ext.commands import CommandError, Context
-from magic import Magic
+from discord.oggparse import OggError, OggStream
 
+from filterchain import loudness_filters
+from probe import analyze, probe, probe_pool, seek_points
+from search import command_search
 from settings import (
     FILES_JSON,
     MIDI_IMPL,
@@ -25,6 +41,10 @@ from settings import (
     MIDI_IMPL_TIMIDITY,
     MIDI_MUTE_124,
     MIDI_MUTE_124_FILE,
+    NORMALIZE_LOUDNESS,
+    OFFLOAD_WORKERS,
+    SEEK_INDEX_EXTENSIONS,
+    SEEK_INDEX_INTERVAL,
     SF2S_JSON,
     UPLOAD_PATH,
 )
@@ -43,8 +63,33 @@ archive_mimetypes = [
     "application/x-gtar",
 ]
 
-magic_mime = Magic(mime=True)
-magic_text = Magic(mime=False)
+# bytes of the file header passed to libmagic
+SNIFF_SIZE = 65536
+# created on first use, libmagic takes a while to load
+magic_mime = None
+
+# {opus_filename: OpusPacketStore or None if unsupported}
+packet_stores: Dict[str, Optional["OpusPacketStore"]] = {}
+
+PACKET_STORE_MAGIC = b"OPKT"
+# duration of a single Opus packet sent to Discord
+PACKET_DURATION = 0.02
+
+# {filename: [(time, byte offset)] or None if not indexed}
+seek_indexes: Dict[str, Optional[List[Tuple[float, int]]]] = {}
+
+SEEK_INDEX_MAGIC = b"SIDX"
+SEEK_POINT = struct.Struct("<dQ")
+
+# blocking calls made on behalf of the event loop
+offload_pool = ThreadPoolExecutor(
+    max_workers=OFFLOAD_WORKERS, thread_name_prefix="offload"
+)
+# calls taking longer than this are logged
+OFFLOAD_SLOW_TIME = 0.1
+# {name: [calls, total time, max time]} of the offloaded calls
+offload_times: Dict[str, List[float]] = {}
+offload_times_lock = Lock()
 
 
 class FFmpegFileOpusAudio(FFmpegOpusAudio):
@@ -55,9 +100,28 @@ class FFmpegFileOpusAudio(FFmpegOpusAudio):
         extra_opts: List[str],
         start: float,
         *args,
+        seek: float = 0.0,
+        loop: bool = False,
         **kwargs,
     ):
         self.filename = filename
+        # loop the input in the same process, without gaps between iterations
+        self.loop = loop
+        before_opts = "-stream_loop -1" if loop else ""
+
+        # 'start' skips the decoded output, 'seek' is an offset in the input
+        if seek:
+            index = load_seek_index(filename) or []
+            i = bisect_right(index, (seek, 1 << 64))
+            if i:
+                # read from a packet near the offset, trim the rest exactly
+                offset, pos = index[i - 1]
+                before_opts += f" -skip_initial_bytes {pos}"
+                trim = [f"atrim=start={seek - offset:.03f}", "asetpts=PTS-STARTPTS"]
+                filters = trim + filters
+            else:
+                before_opts += f" -ss {seek:.03f}"
+
         if filters:
             opts = "-af " + ",".join(filters)
         else:
@@ -68,7 +132,9 @@ class FFmpegFileOpusAudio(FFmpegOpusAudio):
         if start:
             opts += f" -ss {start:.02f}"
 
-        super().__init__(filename, options=opts, *args, **kwargs)
+        super().__init__(
+            filename, before_options=before_opts.strip(), options=opts, *args, **kwargs
+        )
 
 
 class FFmpegMidiOpusAudio(FFmpegOpusAudio):
@@ -102,6 +168,10 @@ class FFmpegMidiOpusAudio(FFmpegOpusAudio):
         if extra_opts:
             opts += " " + " ".join(extra_opts)
 
+        # the synthesizer output is a pipe, so it can only be skipped
+        if start:
+            opts += f" -ss {start:.02f}"
+
         super().__init__(
             "-", before_options=" ".join(before_opts), options=opts, *args, **kwargs
         )
@@ -175,6 +245,325 @@ class FFmpegMidiOpusAudio(FFmpegOpusAudio):
             return process
 
 
+class OpusPacketStore:
+    """Opus packets of a single file, memory-mapped once and shared by all guilds.
+
+    The file consists of a header (magic and packet count), an index
+    of packet offsets relative to the end of the index and the packet data.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self.data = mmap(f.fileno(), 0, access=ACCESS_READ)
+        if self.data[0:4] != PACKET_STORE_MAGIC:
+            raise ValueError(f"Not a packet store: {filename}")
+        (self.count,) = struct.unpack_from("<I", self.data, 4)
+        self.index = 8
+        self.start = self.index + 8 * (self.count + 1)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def packet(self, index: int) -> bytes:
+        start, end = struct.unpack_from("<QQ", self.data, self.index + 8 * index)
+        return self.data[self.start + start : self.start + end]
+
+
+class OpusPacketAudio(AudioSource):
+    def __init__(self, store: OpusPacketStore, start: float, loop: bool = False):
+        self.store = store
+        self.filename = store.filename
+        # can be changed while playing, the source ends after the current iteration
+        self.loop = loop
+        self.cursor = 0
+        self.seek(start)
+
+    def seek(self, position: float):
+        self.cursor = min(int(position / PACKET_DURATION), len(self.store))
+
+    def read(self) -> bytes:
+        if self.cursor >= len(self.store):
+            if not self.loop or not len(self.store):
+                return b""
+            self.cursor = 0
+        data = self.store.packet(self.cursor)
+        self.cursor += 1
+        return data
+
+    def is_opus(self) -> bool:
+        return True
+
+
+class BufferedAudio(AudioSource):
+    """Wraps a source, reading its first packets before the playback starts."""
+
+    def __init__(self, source: AudioSource, count: int = 1):
+        self.source = source
+        self.filename = getattr(source, "filename", None)
+        self.buffer = deque(source.read() for _ in range(count))
+
+    def read(self) -> bytes:
+        if self.buffer:
+            return self.buffer.popleft()
+        return self.source.read()
+
+    def clear(self):
+        # drop the packets read before seeking the source
+        self.buffer.clear()
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+
+class ClockedAudio(AudioSource):
+    """Wraps a source, counting the frames actually read by the player.
+
+    Frames aren't read while paused or stalled, so the position doesn't
+    drift from the audio that was sent.
+    """
+
+    def __init__(self, source: AudioSource, start: float = 0.0):
+        self.source = source
+        self.filename = getattr(source, "filename", None)
+        self.start = start
+        self.frames = 0
+
+    def read(self) -> bytes:
+        data = self.source.read()
+        if data:
+            self.frames += 1
+        return data
+
+    def position(self) -> float:
+        # seconds of output played, including the starting offset
+        return self.start + self.frames * PACKET_DURATION
+
+    def is_opus(self) -> bool:
+        return self.source.is_opus()
+
+    def cleanup(self):
+        self.source.cleanup()
+
+
+def find_source(source: Optional[AudioSource], cls) -> Optional[AudioSource]:
+    # look through the wrapping sources for one of type cls
+    while source is not None:
+        if isinstance(source, cls):
+            return source
+        source = getattr(source, "source", None)
+    return None
+
+
+class ShuffleBag:
+    """Random order of items, without repeating any until all of them are picked.
+
+    Items are stored as integer ids in a permutation, picked items are
+    kept before the cursor. Picking, adding and removing items is O(1).
+    """
+
+    def __init__(self, items: Iterable[str] = ()):
+        # {id: item}, None for removed items
+        self.items: List[Optional[str]] = []
+        # {item: id}
+        self.ids: Dict[str, int] = {}
+        # ids of removed items, to be reused
+        self.free: List[int] = []
+        # permutation of ids, [0:cursor] were already picked
+        self.order = array("I")
+        # {id: index in order}
+        self.position = array("I")
+        self.cursor = 0
+        # the list passed to update() last time
+        self.source = None
+        for item in items:
+            self.add(item)
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def __contains__(self, item: str) -> bool:
+        return item in self.ids
+
+    def _swap(self, i: int, j: int):
+        order = self.order
+        order[i], order[j] = order[j], order[i]
+        self.position[order[i]] = i
+        self.position[order[j]] = j
+
+    def add(self, item: str):
+        if item in self.ids:
+            return
+        if self.free:
+            item_id = self.free.pop()
+            self.items[item_id] = item
+        else:
+            item_id = len(self.items)
+            self.items.append(item)
+            self.position.append(0)
+        self.ids[item] = item_id
+        # new items are not picked yet
+        self.position[item_id] = len(self.order)
+        self.order.append(item_id)
+
+    def remove(self, item: str):
+        item_id = self.ids.pop(item, None)
+        if item_id is None:
+            return
+        index = self.position[item_id]
+        if index < self.cursor:
+            # move to the end of the picked part, then shrink it
+            self.cursor -= 1
+            self._swap(index, self.cursor)
+            index = self.cursor
+        self._swap(index, len(self.order) - 1)
+        self.order.pop()
+        self.items[item_id] = None
+        self.free.append(item_id)
+
+    def update(self, items: List[str]):
+        # skip synchronizing with the same, unchanged list
+        if items is self.source:
+            return
+        self.source = items
+        keep = set(items)
+        for item in [item for item in self.ids if item not in keep]:
+            self.remove(item)
+        for item in items:
+            self.add(item)
+
+    def is_picked(self, item: str) -> bool:
+        # start over if all items were picked
+        if self.cursor >= len(self.order):
+            self.cursor = 0
+        return self.position[self.ids[item]] < self.cursor
+
+    def take(self, item: str):
+        # mark an item chosen elsewhere as picked
+        if self.is_picked(item):
+            return
+        self._swap(self.position[self.ids[item]], self.cursor)
+        self.cursor += 1
+
+    def pick(self) -> Optional[str]:
+        if not self.order:
+            return None
+        # start over if all items were picked
+        if self.cursor >= len(self.order):
+            self.cursor = 0
+        # one step of Fisher-Yates shuffle
+        self._swap(self.cursor, randrange(self.cursor, len(self.order)))
+        item = self.items[self.order[self.cursor]]
+        self.cursor += 1
+        return item
+
+
+def alias_arrays(weights: List[float]) -> Tuple[array, array]:
+    # Vose's alias method, uniform if all weights are zero
+    count = len(weights)
+    prob = array("d", [1.0] * count)
+    alias = array("I", range(count))
+    total = sum(weights)
+    if not total:
+        return prob, alias
+    scaled = [weight * count / total for weight in weights]
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        prob[less] = scaled[less]
+        alias[less] = more
+        scaled[more] += scaled[less] - 1.0
+        (small if scaled[more] < 1.0 else large).append(more)
+    # the rest have probability 1.0 (up to rounding errors)
+    return prob, alias
+
+
+def alias_sample(prob: array, alias: array) -> int:
+    i = randrange(len(prob))
+    if random() >= prob[i]:
+        i = alias[i]
+    return i
+
+
+class AliasTable:
+    """Weighted random choice in O(1), using Vose's alias method.
+
+    The items are split into blocks with an alias table each, and a block
+    is picked by an alias table of the block totals. Changing an item only
+    rebuilds its block and the table of the blocks.
+    """
+
+    def __init__(self, weights: Dict[str, float]):
+        self.items = list(weights.keys())
+        self.weights = list(weights.values())
+        self.index = {name: i for i, name in enumerate(self.items)}
+        # sqrt(n) keeps both rebuilds short, the table is not resized
+        self.block_size = max(int(len(self.items) ** 0.5), 16)
+        self.blocks: List[Tuple[array, array]] = []
+        self.totals: List[float] = []
+        for block in range(0, len(self.items), self.block_size):
+            self.build_block(block // self.block_size)
+        self.top = alias_arrays(self.totals)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def build_block(self, block: int):
+        start = block * self.block_size
+        weights = self.weights[start : start + self.block_size]
+        if not weights:
+            # the last block was emptied
+            del self.blocks[block:]
+            del self.totals[block:]
+            return
+        if block == len(self.blocks):
+            self.blocks.append(alias_arrays(weights))
+            self.totals.append(sum(weights))
+            return
+        self.blocks[block] = alias_arrays(weights)
+        self.totals[block] = sum(weights)
+
+    def set(self, name: str, weight: float):
+        i = self.index.get(name, None)
+        if i is None:
+            i = self.index[name] = len(self.items)
+            self.items.append(name)
+            self.weights.append(weight)
+        else:
+            self.weights[i] = weight
+        self.build_block(i // self.block_size)
+        self.top = alias_arrays(self.totals)
+
+    def remove(self, name: str):
+        i = self.index.pop(name, None)
+        if i is None:
+            return
+        # move the last item into the place of the removed one
+        last = len(self.items) - 1
+        if i != last:
+            self.items[i] = self.items[last]
+            self.weights[i] = self.weights[last]
+            self.index[self.items[i]] = i
+        self.items.pop()
+        self.weights.pop()
+        self.build_block(i // self.block_size)
+        if last // self.block_size != i // self.block_size:
+            self.build_block(last // self.block_size)
+        self.top = alias_arrays(self.totals)
+
+    def sample(self) -> Optional[str]:
+        if not self.items:
+            return None
+        block = alias_sample(*self.top)
+        i = alias_sample(*self.blocks[block])
+        return self.items[block * self.block_size + i]
+
+
 @dataclass
 class ReplayInfo:
     channel: VoiceChannel
@@ -183,8 +572,23 @@ class ReplayInfo:
     cmd_name: str
     cmd_orig: str
     filename: str
-    timestamp: float
+    clock: ClockedAudio
     speed: int
+    # DSPAudio of the playing source, if any
+    dsp: Optional[AudioSource] = None
+
+    def position(self) -> float:
+        # seconds of the file played, at normal speed
+        return self.clock.position() * self.speed / 100.0
+
+
+@dataclass
+class PrefetchInfo:
+    cmd: dict
+    cmd_name: str
+    cmd_orig: str
+    filename: str
+    source: BufferedAudio
 
 
 async def connect_to(channel: VoiceChannel) -> VoiceClient:
@@ -254,7 +658,11 @@ async def ensure_can_modify(ctx: Context, cmd: dict):
 
 async def ensure_command(ctx: Context, name: str, files: Dict[str, dict]) -> dict:
     if name not in files:
-        await ctx.send(f":x: The command `!{name}` does not exist.", delete_after=3)
+        suggestions = [f"`!{s}`" for s in command_search.suggest(name)]
+        hint = f" Did you mean {', '.join(suggestions)}?" if suggestions else ""
+        await ctx.send(
+            f":x: The command `!{name}` does not exist.{hint}", delete_after=3
+        )
         raise CommandError(f"No such command: {name}")
     return files[name]
 
@@ -298,6 +706,20 @@ def pack_dirname(filename: str) -> str:
     return dirname
 
 
+def original_filename(filename: str) -> str:
+    # remove the upload timestamp prefix
+    prefix, _, name = basename(filename).partition("_")
+    return name if prefix.isdigit() and name else basename(filename)
+
+
+def upload_time(cmd: dict) -> int:
+    if "uploaded" in cmd:
+        return cmd["uploaded"]
+    # legacy files and packs are prefixed with the upload timestamp
+    prefix = basename(cmd["filename"]).partition("_")[0]
+    return int(prefix) if prefix.isdigit() else 0
+
+
 def real_filename(cmd: dict) -> str:
     filename = cmd["filename"]
     if not isabs(filename):
@@ -305,41 +727,259 @@ def real_filename(cmd: dict) -> str:
     return filename
 
 
-def filetype(filename: str) -> str:
-    mime = magic_mime.from_file(filename)
-    text = magic_text.from_file(filename)
-    return mime, text
+def load_magic():
+    global magic_mime
+    if not magic_mime:
+        from magic import Magic
 
+        magic_mime = Magic(mime=True)
 
-def check_file(filename: str) -> Tuple[bool, bool, bool, bool, bool]:
-    mime_type, mime_text = filetype(filename)
-    soundfont = "audio/x-sfbk" == mime_type or "SoundFont/Bank" in mime_text
-    if soundfont:
+
+def check_buffer(data: bytes) -> Tuple[bool, bool, bool, bool, bool]:
+    # SoundFonts are RIFF files, recognize them without asking libmagic
+    if data[0:4] == b"RIFF" and data[8:12] == b"sfbk":
         return False, False, True, False, False
+    load_magic()
+    mime_type = magic_mime.from_buffer(data[0:SNIFF_SIZE])
     audio = mime_type.startswith("audio/")
     video = mime_type.startswith("video/")
     archive = mime_type in archive_mimetypes
     midi = "audio/midi" == mime_type
-    return audio or video, archive, soundfont, midi, video
+    return audio or video, archive, False, midi, video
+
 
+def is_opus_passthrough(info: dict) -> bool:
+    # Opus is always decoded at 48 kHz, so only the channel count matters
+    return info.get("codec") == "opus" and info.get("channels", 0) <= 2
 
-def get_audio_info(filename: str) -> Union[dict, None]:
+
+def transcode_opus(
+    filename: str,
+    output: str,
+    filters: List[str] = None,
+    extra_opts: List[str] = None,
+) -> bool:
+    # renditions are shared and reused once they exist, so they're written
+    # under a temporary name and never left truncated
+    tmp = f"{output}.{get_ident()}.tmp"
     cmd = [
-        "ffprobe",
-        "-show_streams",
-        "-of json",
-        quote(filename),
+        "ffmpeg",
+        "-y",
+        *("-i", filename),
+        "-vn",
+        *("-map_metadata", "-1"),
+        *(("-af", ",".join(filters)) if filters else ()),
+        *("-c:a", "libopus"),
+        *("-ar", "48000"),
+        *("-ac", "2"),
+        *("-b:a", "128k"),
+        # options of the command override the defaults
+        *(arg for opt in extra_opts or [] for arg in shlex_split(opt)),
+        *("-f", "opus"),
+        *("-loglevel", "warning"),
+        tmp,
     ]
-    cmd = " ".join(cmd)
-    result = subprocess.run(split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    data = result.stdout.decode()
-    data = json.loads(data)
-    if not "streams" in data:
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        if isfile(tmp):
+            unlink(tmp)
+        return False
+    replace(tmp, output)
+    return True
+
+
+def rendition_filters(info: dict) -> List[str]:
+    # static per file, so they're applied when transcoding the rendition
+    return loudness_filters(info) if NORMALIZE_LOUDNESS else []
+
+
+def rendition_filename(filename: str, filters: List[str]) -> str:
+    if not filters:
+        return f"{filename}.opus"
+    digest = hashlib.sha1(",".join(filters).encode()).hexdigest()[0:8]
+    return f"{filename}.{digest}.opus"
+
+
+def fill_opus_rendition(cmd: dict):
+    pack = "pack" in cmd and cmd["pack"]
+    midi = "midi" in cmd and cmd["midi"]
+    if pack or midi or "info" not in cmd:
+        return
+    filters = rendition_filters(cmd["info"])
+    if is_opus_passthrough(cmd["info"]) and not filters:
+        # the source can be played with codec copy directly
+        cmd["opus"] = cmd["filename"]
+        cmd.pop("opus_filters", None)
+        ensure_packet_store(real_filename(cmd))
+        return
+    filename = real_filename(cmd)
+    output = rendition_filename(filename, filters)
+    # renditions of deduplicated uploads are shared
+    if not isfile(output) and not transcode_opus(filename, output, filters):
+        return
+    cmd["opus"] = relpath(output, UPLOAD_PATH)
+    if filters:
+        cmd["opus_filters"] = filters
+    else:
+        cmd.pop("opus_filters", None)
+    ensure_packet_store(output)
+
+
+def refresh_opus_rendition(cmd: dict):
+    if "info" not in cmd:
+        return
+    filters = rendition_filters(cmd["info"])
+    if cmd.get("opus_filters", []) == filters and opus_filename(cmd):
+        return
+    remove_opus_rendition(cmd)
+    fill_opus_rendition(cmd)
+
+
+def opus_filename(cmd: dict) -> Optional[str]:
+    if "opus" not in cmd:
         return None
-    data = [s for s in data["streams"] if s["codec_type"] == "audio"]
-    if not data:
+    filename = cmd["opus"]
+    if not isabs(filename):
+        filename = join(UPLOAD_PATH, filename)
+    if not isfile(filename):
         return None
-    return data[0]
+    return filename
+
+
+def remove_opus_rendition(cmd: dict):
+    filename = opus_filename(cmd)
+    cmd.pop("opus", None)
+    cmd.pop("opus_filters", None)
+    if not filename:
+        return
+    # playing sources keep their own reference to the store
+    packet_stores.pop(filename, None)
+    # renditions of deduplicated uploads may be removed by another descriptor
+    if isfile(f"{filename}.pkt"):
+        unlink(f"{filename}.pkt")
+    # do not remove passthrough sources
+    if filename != real_filename(cmd) and isfile(filename):
+        unlink(filename)
+
+
+def opus_packet_duration(packet: bytes) -> float:
+    # read the frame size and count from the TOC byte (RFC 6716, 3.1)
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        frame = (10, 20, 40, 60)[config % 4]
+    elif config < 16:
+        frame = (10, 20)[config % 2]
+    else:
+        frame = (2.5, 5, 10, 20)[config % 4]
+    code = toc & 0x03
+    if code == 0:
+        count = 1
+    elif code in (1, 2):
+        count = 2
+    else:
+        count = packet[1] & 0x3F
+    return frame * count / 1000.0
+
+
+def build_packet_store(filename: str, output: str) -> bool:
+    packets = []
+    try:
+        with open(filename, "rb") as f:
+            for packet in OggStream(f).iter_packets():
+                if packet[0:8] in (b"OpusHead", b"OpusTags"):
+                    continue
+                # the player sends one packet per 20 ms
+                if abs(opus_packet_duration(packet) - PACKET_DURATION) > 0.001:
+                    return False
+                packets.append(packet)
+    except (OggError, IndexError):
+        return False
+
+    tmp = f"{output}.{get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(PACKET_STORE_MAGIC)
+        f.write(struct.pack("<I", len(packets)))
+        offset = 0
+        f.write(struct.pack("<Q", offset))
+        for packet in packets:
+            offset += len(packet)
+            f.write(struct.pack("<Q", offset))
+        for packet in packets:
+            f.write(packet)
+    replace(tmp, output)
+    return True
+
+
+def ensure_packet_store(filename: str) -> bool:
+    output = f"{filename}.pkt"
+    return isfile(output) or build_packet_store(filename, output)
+
+
+def load_packet_store(filename: str) -> Optional[OpusPacketStore]:
+    if filename in packet_stores:
+        return packet_stores[filename]
+    if not ensure_packet_store(filename):
+        # remember unsupported files to avoid parsing them again
+        packet_stores[filename] = None
+        return None
+    store = packet_stores[filename] = OpusPacketStore(f"{filename}.pkt")
+    return store
+
+
+def build_seek_index(filename: str, output: str) -> bool:
+    points = seek_points(filename, SEEK_INDEX_INTERVAL)
+    if not points:
+        return False
+    with open(output, "wb") as f:
+        f.write(SEEK_INDEX_MAGIC)
+        f.write(struct.pack("<I", len(points)))
+        for point in points:
+            f.write(SEEK_POINT.pack(*point))
+    return True
+
+
+def read_seek_index(filename: str) -> Optional[List[Tuple[float, int]]]:
+    with open(filename, "rb") as f:
+        if f.read(len(SEEK_INDEX_MAGIC)) != SEEK_INDEX_MAGIC:
+            return None
+        (count,) = struct.unpack("<I", f.read(4))
+        data = f.read(count * SEEK_POINT.size)
+    return list(SEEK_POINT.iter_unpack(data))
+
+
+def index_file(filename: str):
+    output = f"{filename}.idx"
+    if not isfile(output) and not build_seek_index(filename, output):
+        print(f"Couldn't build a seek index of '{filename}'")
+        return
+    seek_indexes[filename] = read_seek_index(output)
+
+
+def load_seek_index(filename: str) -> Optional[List[Tuple[float, int]]]:
+    # built in the background on first use, ffmpeg seeks the file until then;
+    # the whole file is read, so not in offload_pool with the playback lookups
+    if filename in seek_indexes:
+        return seek_indexes[filename]
+    seek_indexes[filename] = None
+    if splitext(filename)[1].lower() in SEEK_INDEX_EXTENSIONS:
+        probe_pool.submit(index_file, filename)
+    return None
+
+
+def remove_seek_index(filename: str):
+    seek_indexes.pop(filename, None)
+    if isfile(f"{filename}.idx"):
+        unlink(f"{filename}.idx")
+
+
+def prepare_file_rendition(filename: str) -> Optional[str]:
+    # for files without a command descriptor, like ESPIONAGE_FILE
+    output = f"{filename}.opus"
+    if not isfile(output) and not transcode_opus(filename, output):
+        return None
+    load_packet_store(output)
+    return output
 
 
 def fill_audio_info(cmd: dict):
@@ -348,15 +988,18 @@ def fill_audio_info(cmd: dict):
     if pack or midi:
         return
     filename = real_filename(cmd)
-    info = get_audio_info(filename)
+    info = probe(filename)
     if not info:
         return
-    cmd["info"] = {
-        "sample_rate": int(info["sample_rate"]),
-        "duration": float(info.get("duration") or 0),
-        "channels": int(info["channels"]),
-        "codec": info["codec_name"],
-    }
+    cmd["info"] = dict(info)
+    fill_audio_analysis(cmd)
+
+
+def fill_audio_analysis(cmd: dict):
+    info = cmd.get("info", None)
+    if not info or "loudness" in info:
+        return
+    info.update(analyze(real_filename(cmd), info["duration"]))
 
 
 def load_files() -> Dict[str, dict]:
@@ -367,11 +1010,6 @@ def load_files() -> Dict[str, dict]:
     return files
 
 
-def save_files(files: Dict[str, dict]):
-    with open(FILES_JSON, "w") as f:
-        json.dump(files, f, indent=4)
-
-
 def load_sf2s() -> Dict[str, dict]:
     if not isfile(SF2S_JSON):
         return {}
@@ -380,6 +1018,33 @@ def load_sf2s() -> Dict[str, dict]:
     return sf2s
 
 
-def save_sf2s(sf2s: Dict[str, dict]):
-    with open(SF2S_JSON, "w") as f:
-        json.dump(sf2s, f, indent=4)
+def timed_call(func: Callable, *args) -> Any:
+    start = perf_counter()
+    try:
+        return func(*args)
+    finally:
+        elapsed = perf_counter() - start
+        name = getattr(func, "__qualname__", repr(func))
+        with offload_times_lock:
+            times = offload_times.setdefault(name, [0, 0.0, 0.0])
+            times[0] += 1
+            times[1] += elapsed
+            times[2] = max(times[2], elapsed)
+        if elapsed > OFFLOAD_SLOW_TIME:
+            print(f"Slow call: {name} took {elapsed:.03f} s")
+
+
+def print_offload_times():
+    with offload_times_lock:
+        items = sorted(offload_times.items(), key=lambda item: -item[1][1])
+    for name, (calls, total, longest) in items:
+        print(
+            f"Offloaded {name}: {calls} calls, "
+            f"{total / calls * 1000:.01f} ms average, {longest * 1000:.01f} ms max"
+        )
+
+
+async def offload(func: Callable, *args) -> Any:
+    # run a blocking call without stalling the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(offload_pool, timed_call, func, *args)
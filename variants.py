@@ -0,0 +1,135 @@
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from os import scandir, stat, unlink, utime
+from os.path import isfile, join
+from threading import Lock
+from time import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from settings import RENDER_WORKERS, VARIANT_CACHE_SIZE, VARIANT_PATH
+from utils import ensure_packet_store, packet_stores, transcode_opus
+
+# full-file renders, kept apart from the playback lookups in offload_pool
+render_pool = ThreadPoolExecutor(
+    max_workers=RENDER_WORKERS, thread_name_prefix="render"
+)
+
+
+class VariantCache:
+    """Files pre-rendered with their filters and speed, played from packet stores.
+
+    Variants are rendered in the background on the first play, and the
+    least recently played ones are removed when the cache exceeds
+    VARIANT_CACHE_SIZE.
+    """
+
+    # {key: [size, last used]}
+    entries: Dict[str, list]
+    # {key}
+    rendering: Set[str]
+    # {key}, not retried until a restart
+    failed: Set[str]
+
+    def __init__(self):
+        self.entries = {}
+        self.rendering = set()
+        self.failed = set()
+        # variants are looked up from worker threads too
+        self.lock = Lock()
+        with scandir(VARIANT_PATH) as it:
+            for entry in it:
+                if not entry.is_file():
+                    continue
+                key, _, ext = entry.name.partition(".")
+                if ext not in ("opus", "opus.pkt"):
+                    # interrupted renders
+                    unlink(entry.path)
+                    continue
+                st = entry.stat()
+                item = self.entries.setdefault(key, [0, 0.0])
+                item[0] += st.st_size
+                item[1] = max(item[1], st.st_mtime)
+
+    @staticmethod
+    def make_key(
+        cmd: dict, filename: str, filters: List[str], extra_opts: List[str]
+    ) -> str:
+        if "hash" in cmd:
+            source = cmd["hash"]
+        else:
+            st = stat(filename)
+            source = f"{filename}:{st.st_size}:{st.st_mtime}"
+        chain = ",".join(filters) + "|" + " ".join(extra_opts)
+        return hashlib.sha1(f"{source}|{chain}".encode()).hexdigest()
+
+    @staticmethod
+    def path(key: str) -> str:
+        return join(VARIANT_PATH, f"{key}.opus")
+
+    def get(
+        self, cmd: dict, filename: str, filters: List[str], extra_opts: List[str]
+    ) -> Tuple[Optional[str], bool]:
+        # returns the rendered file, or schedules rendering it
+        # and whether the variant is being rendered
+        key = self.make_key(cmd, filename, filters, extra_opts)
+        path = self.path(key)
+        with self.lock:
+            if key in self.entries and key not in self.rendering:
+                self.entries[key][1] = time()
+                try:
+                    # keep the order after a restart
+                    utime(path)
+                    return path, False
+                except OSError:
+                    del self.entries[key]
+            if key in self.failed:
+                return None, False
+            if key in self.rendering:
+                return None, True
+            self.rendering.add(key)
+        render_pool.submit(self.render, key, filename, filters, extra_opts)
+        return None, True
+
+    def render(
+        self, key: str, filename: str, filters: List[str], extra_opts: List[str]
+    ):
+        path = self.path(key)
+        try:
+            if not transcode_opus(filename, path, filters, extra_opts):
+                print(f"Couldn't render '{filename}' with {filters} {extra_opts}")
+                with self.lock:
+                    self.failed.add(key)
+                return
+            ensure_packet_store(path)
+            size = stat(path).st_size
+            if isfile(f"{path}.pkt"):
+                size += stat(f"{path}.pkt").st_size
+            with self.lock:
+                self.entries[key] = [size, time()]
+            print(f"Rendered '{filename}' with {filters} {extra_opts}")
+        finally:
+            with self.lock:
+                self.rendering.discard(key)
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            total = sum(size for size, _ in self.entries.values())
+            if total <= VARIANT_CACHE_SIZE:
+                return
+            keys = sorted(self.entries, key=lambda key: self.entries[key][1])
+            removed = []
+            for key in keys:
+                if total <= VARIANT_CACHE_SIZE:
+                    break
+                total -= self.entries.pop(key)[0]
+                removed.append(key)
+        for key in removed:
+            path = self.path(key)
+            # playing sources keep their own reference to the store
+            packet_stores.pop(path, None)
+            for name in [path, f"{path}.pkt"]:
+                try:
+                    unlink(name)
+                except OSError:
+                    pass